@@ -0,0 +1,75 @@
+"""
+Benchmark of `Load Image Batch From Dir (Inspire)` decoding: serial (decode_workers=1) vs thread pool (decode_workers=0).
+
+A synthetic directory of PNG files is generated in a temporary directory.
+Run it with the python of ComfyUI, while this pack is installed in `ComfyUI/custom_nodes`:
+
+    python custom_nodes/ComfyUI-Inspire-Pack/benchmarks/bench_load_images.py --count 200 --size 768
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+pack_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+comfy_path = os.path.dirname(os.path.dirname(pack_path))
+sys.path.insert(0, comfy_path)
+sys.path.insert(0, pack_path)
+
+import numpy as np
+import torch
+from PIL import Image
+
+from inspire import image_util
+
+
+def make_images(directory, count, size, seed=0):
+    rng = np.random.default_rng(seed)
+
+    # smooth gradients + noise, so the PNGs are not trivially compressible
+    y, x = np.mgrid[0:size, 0:size]
+    base = np.stack([x, y, (x + y) // 2], axis=-1) * (255.0 / (size * 1.5))
+
+    for i in range(count):
+        noise = rng.integers(0, 64, size=(size, size, 3))
+        pixels = np.clip(base + noise, 0, 255).astype(np.uint8)
+        Image.fromarray(pixels).save(os.path.join(directory, f"{i:05}.png"))
+
+
+def run(directory, decode_workers, repeat):
+    timings = []
+    for _ in range(repeat):
+        # measure the decoding, not the cache
+        image_util.decoded_image_cache.clear()
+
+        start = time.perf_counter()
+        # ComfyUI executes the nodes in inference mode
+        with torch.inference_mode():
+            images, _, count = image_util.LoadImagesFromDirBatch().load_images(directory, decode_workers=decode_workers)
+        timings.append(time.perf_counter() - start)
+
+    return min(timings), count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=100, help="number of images")
+    parser.add_argument("--size", type=int, default=512, help="width and height of the images")
+    parser.add_argument("--repeat", type=int, default=3, help="best of N runs")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"generating {args.count} PNG files ({args.size}x{args.size}) ...")
+        make_images(directory, args.count, args.size)
+
+        serial, count = run(directory, 1, args.repeat)
+        parallel, _ = run(directory, 0, args.repeat)
+
+    print(f"decode_workers=1: {serial:.3f}s ({count / serial:.1f} images/s)")
+    print(f"decode_workers=0: {parallel:.3f}s ({count / parallel:.1f} images/s, {os.cpu_count()} CPUs)")
+    print(f"speedup: x{serial / parallel:.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,11 +4,14 @@ from .libs import utils
 from einops import rearrange
 import random
 import math
+import traceback
 from .libs import common
+from .libs import sampler_stats
+from .libs import sampling_cache
 
 
 class Inspire_RandomNoise:
-    def __init__(self, seed, mode, incremental_seed_mode, variation_seed, variation_strength, variation_method="linear"):
+    def __init__(self, seed, mode, incremental_seed_mode, variation_seed, variation_strength, variation_method="linear", variation_sweep=None):
         device = comfy.model_management.get_torch_device()
         self.seed = seed
         self.noise_device = "cpu" if mode == "CPU" else device
@@ -16,42 +19,133 @@ class Inspire_RandomNoise:
         self.variation_seed = variation_seed
         self.variation_strength = variation_strength
         self.variation_method = variation_method
+        self.variation_sweep = variation_sweep
 
     def generate_noise(self, input_latent):
         latent_image = input_latent["samples"]
         batch_inds = input_latent["batch_index"] if "batch_index" in input_latent else None
         noise = utils.prepare_noise(latent_image, self.seed, batch_inds, self.noise_device, self.incremental_seed_mode,
-                                    variation_seed=self.variation_seed, variation_strength=self.variation_strength, variation_method=self.variation_method)
+                                    variation_seed=self.variation_seed, variation_strength=self.variation_strength, variation_method=self.variation_method,
+                                    variation_sweep=self.variation_sweep)
         return noise.cpu()
 
 
+class Inspire_LazyNoise:
+    """
+    NOISE descriptor that is composed across nodes and materialized only once, on the sampling device.
+    The base is either a seed (generated from `latent_image`) or an already materialized noise tensor.
+    """
+    def __init__(self, latent_image=None, seed=0, noise_device="cpu", incremental_seed_mode="comfy", base_noise=None, variations=None):
+        self.latent_image = latent_image
+        self.seed = seed
+        self.noise_device = noise_device
+        self.incremental_seed_mode = incremental_seed_mode
+        self.base_noise = base_noise
+        self.variations = variations or []  # [(variation_seed, variation_strength, noise_device, mask), ...]
+
+    @staticmethod
+    def from_noise(noise):
+        if isinstance(noise, Inspire_LazyNoise):
+            return noise
+
+        return Inspire_LazyNoise(base_noise=noise)
+
+    @property
+    def shape(self):
+        if self.base_noise is not None:
+            return self.base_noise.shape
+
+        return self.latent_image.shape
+
+    def with_variations(self, variations, noise_device, mask=None):
+        new_variations = self.variations + [(seed, strength, noise_device, mask) for seed, strength in variations]
+        return Inspire_LazyNoise(self.latent_image, self.seed, self.noise_device, self.incremental_seed_mode,
+                                 base_noise=self.base_noise, variations=new_variations)
+
+    def materialize(self, device):
+        if self.base_noise is not None:
+            noise = self.base_noise.to(device)
+        else:
+            noise = utils.prepare_noise(self.latent_image, self.seed, None, self.noise_device, self.incremental_seed_mode)
+            noise = noise.to(device)
+
+        for variation_seed, variation_strength, noise_device, mask in self.variations:
+            try:
+                if mask is not None:
+                    mask = mask.to(device)
+
+                noise = utils.apply_variation_noise(noise, noise_device, variation_seed, variation_strength, mask=mask)
+            except Exception:
+                print(f"[ERROR] IGNORED: failed to apply variation '{variation_seed}:{variation_strength}'")
+                traceback.print_exc()
+
+        return noise
+
+    def generate_noise(self, input_latent):
+        return self.materialize(comfy.model_management.get_torch_device())
+
+
 class RandomNoise:
     @classmethod
     def INPUT_TYPES(s):
         return {"required": {
                     "noise_seed": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff}),
                     "noise_mode": (["GPU(=A1111)", "CPU"],),
-                    "batch_seed_mode": (["incremental", "comfy", "variation str inc:0.01", "variation str inc:0.05"],),
+                    "batch_seed_mode": (["incremental", "comfy", "variation str inc:0.01", "variation str inc:0.05", "variation sweep"],),
                     "variation_seed": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff}),
                     "variation_strength": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1.0, "step": 0.01}),
                     },
                 "optional":
-                    {"variation_method": (["linear", "slerp"],), }
+                    {
+                        "variation_method": (["linear", "slerp"],),
+                        "variation_sweep": ("STRING", {"multiline": False, "placeholder": "variation sweep strengths (e.g. '0.1, 0.2, 0.3' or '0.0~1.0')"}),
+                    }
                 }
 
     RETURN_TYPES = ("NOISE",)
     FUNCTION = "get_noise"
     CATEGORY = "InspirePack/a1111_compat"
 
-    def get_noise(self, noise_seed, noise_mode, batch_seed_mode, variation_seed, variation_strength, variation_method="linear"):
-        return (Inspire_RandomNoise(noise_seed, noise_mode, batch_seed_mode, variation_seed, variation_strength, variation_method=variation_method),)
+    def get_noise(self, noise_seed, noise_mode, batch_seed_mode, variation_seed, variation_strength, variation_method="linear", variation_sweep=None):
+        return (Inspire_RandomNoise(noise_seed, noise_mode, batch_seed_mode, variation_seed, variation_strength, variation_method=variation_method,
+                                    variation_sweep=variation_sweep),)
 
 
-def inspire_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent, denoise=1.0,
-                     noise_mode="CPU", disable_noise=False, start_step=None, last_step=None, force_full_denoise=False,
-                     incremental_seed_mode="comfy", variation_seed=None, variation_strength=None, noise=None, callback=None, variation_method="linear"):
-    device = comfy.model_management.get_torch_device()
-    noise_device = "cpu" if noise_mode == "CPU" else device
+class EarlyExit(Exception):
+    def __init__(self, x0):
+        super().__init__("early exit")
+        self.x0 = x0
+
+
+class ConvergenceMonitor:
+    """
+    sampling callback that counts the executed steps and stops the sampling (raises `EarlyExit`)
+    when the relative change of the denoised prediction (x0) between steps drops below `threshold` for every batch item.
+    threshold 0 disables the early exit.
+    """
+    def __init__(self, threshold=0.0, callback=None):
+        self.threshold = threshold
+        self.callback = callback
+        self.prev_x0 = None
+        self.steps = 0
+
+    def __call__(self, step, x0, x, total_steps):
+        self.steps += 1
+
+        if self.callback is not None:
+            self.callback(step, x0, x, total_steps)
+
+        if self.threshold > 0 and step < total_steps - 1:
+            if self.prev_x0 is not None:
+                delta = (x0 - self.prev_x0).flatten(1).norm(dim=1) / self.prev_x0.flatten(1).norm(dim=1).clamp_min(1e-6)
+                if delta.max().item() < self.threshold:
+                    raise EarlyExit(x0)
+
+            self.prev_x0 = x0
+
+
+def prepare_sampling_noise(latent, seed, noise_device, disable_noise=False, noise=None, incremental_seed_mode="comfy", variation_seed=None, variation_strength=None,
+                           variation_method="linear", variation_sweep=None):
     latent_image = latent["samples"]
 
     if noise is None:
@@ -61,7 +155,29 @@ def inspire_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive,
         else:
             batch_inds = latent["batch_index"] if "batch_index" in latent else None
             noise = utils.prepare_noise(latent_image, seed, batch_inds, noise_device, incremental_seed_mode,
-                                        variation_seed=variation_seed, variation_strength=variation_strength, variation_method=variation_method)
+                                        variation_seed=variation_seed, variation_strength=variation_strength, variation_method=variation_method,
+                                        variation_sweep=variation_sweep)
+    elif not isinstance(noise, torch.Tensor):
+        # NOISE objects (Inspire_LazyNoise, Inspire_RandomNoise) are materialized here, once
+        noise = noise.generate_noise(latent)
+
+    return noise
+
+
+def inspire_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent, denoise=1.0,
+                     noise_mode="CPU", disable_noise=False, start_step=None, last_step=None, force_full_denoise=False,
+                     incremental_seed_mode="comfy", variation_seed=None, variation_strength=None, noise=None, callback=None, variation_method="linear",
+                     variation_sweep=None):
+    device = comfy.model_management.get_torch_device()
+    noise_device = "cpu" if noise_mode == "CPU" else device
+    timer = sampler_stats.SamplingTimer(device)
+
+    noise = prepare_sampling_noise(latent, seed, noise_device, disable_noise, noise, incremental_seed_mode,
+                                   variation_seed=variation_seed, variation_strength=variation_strength, variation_method=variation_method,
+                                   variation_sweep=variation_sweep)
+    latent_image = latent["samples"]
+
+    timer.lap('noise')
 
     if start_step is None:
         if denoise == 1.0:
@@ -71,9 +187,99 @@ def inspire_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive,
             start_step = advanced_steps - steps
             steps = advanced_steps
 
-    samples = common.impact_sampling(
-        model=model, add_noise=not disable_noise, seed=seed, steps=steps, cfg=cfg, sampler_name=sampler_name, scheduler=scheduler, positive=positive, negative=negative,
-        latent_image=latent, start_at_step=start_step, end_at_step=last_step, return_with_leftover_noise=not force_full_denoise, noise=noise, callback=callback)
+    if isinstance(callback, ConvergenceMonitor) and callback.threshold > 0:
+        # NOTE: the early exit returns the fully denoised x0, which is only valid for a run that denoises to sigma 0.
+        #       a partial run (e.g. the base stage of a base/refiner chain) must hand over a latent that is still noisy.
+        if not force_full_denoise or (last_step is not None and last_step < steps):
+            print(f"[Inspire Pack] WARN: early_exit_threshold is ignored, since the sampling doesn't denoise to the end (return_with_leftover_noise is enabled or end_at_step < steps).")
+            callback.threshold = 0.0
+
+    try:
+        samples = common.impact_sampling(
+            model=model, add_noise=not disable_noise, seed=seed, steps=steps, cfg=cfg, sampler_name=sampler_name, scheduler=scheduler, positive=positive, negative=negative,
+            latent_image=latent, start_at_step=start_step, end_at_step=last_step, return_with_leftover_noise=not force_full_denoise, noise=noise, callback=timer.wrap_callback(callback),
+            scheduler_func=common.get_scheduler_func(scheduler))
+    except EarlyExit as e:
+        # converged: the denoised prediction of the last step is the result
+        samples = latent.copy()
+        samples['samples'] = model.model.process_latent_out(e.x0).to(comfy.model_management.intermediate_device())
+
+    timer.lap('finalize')
+    sampler_stats.report(timer.record(sampler_name=sampler_name, scheduler=scheduler, cfg=cfg, denoise=denoise, shape=list(latent_image.shape)))
+
+    return samples, noise
+
+
+def get_micro_batch_size(model, latent_image):
+    """
+    number of latents that can be sampled at once in the free memory of the sampling device (VRAM, or RAM on CPU)
+    """
+    device = comfy.model_management.get_torch_device()
+
+    try:
+        # NOTE: the model is not loaded here (the sampler loads it with the memory required for sampling),
+        #       so the weights that are not loaded yet are subtracted from the free memory instead.
+        weights_to_load = max(0, model.model_size() - model.loaded_size())
+        free_memory = comfy.model_management.get_free_memory(device) - weights_to_load - comfy.model_management.minimum_inference_memory()
+        memory_per_latent = model.model.memory_required([2] + list(latent_image.shape[1:]))  # cond + uncond
+    except Exception:
+        print(f"[Inspire Pack] WARN: failed to estimate the memory for sampling - micro batching is ignored")
+        return latent_image.shape[0]
+
+    return max(1, int(free_memory // memory_per_latent))
+
+
+def slice_batch(value, batch_size, start, end):
+    if isinstance(value, torch.Tensor) and value.dim() > 0 and value.shape[0] == batch_size:
+        return value[start:end]
+    elif isinstance(value, list) and len(value) == batch_size:
+        return value[start:end]
+
+    return value
+
+
+def slice_conditioning(cond, batch_size, start, end):
+    return [[slice_batch(c, batch_size, start, end), {k: slice_batch(v, batch_size, start, end) for k, v in opts.items()}] for c, opts in cond]
+
+
+def inspire_ksampler_micro_batched(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent, denoise=1.0,
+                                   noise_mode="CPU", disable_noise=False, noise=None, incremental_seed_mode="comfy", variation_seed=None, variation_strength=None,
+                                   variation_method="linear", variation_sweep=None, micro_batch_size=None, **kwargs):
+    """
+    `inspire_ksampler` that splits a large batch into sub-batches which fit in the free memory, and samples them sequentially.
+    the noise of the whole batch is prepared first and sliced, so the initial noise of each batch index is identical to the unsplit run.
+    (the extra noise of ancestral/SDE samplers is drawn per sub-batch from the same seed, so those results differ from the unsplit run)
+    """
+    latent_image = latent["samples"]
+    batch_size = latent_image.shape[0]
+
+    if micro_batch_size is None:
+        micro_batch_size = get_micro_batch_size(model, latent_image)
+
+    if micro_batch_size >= batch_size:
+        return inspire_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent, denoise, noise_mode, disable_noise=disable_noise, noise=noise,
+                                incremental_seed_mode=incremental_seed_mode, variation_seed=variation_seed, variation_strength=variation_strength,
+                                variation_method=variation_method, variation_sweep=variation_sweep, **kwargs)
+
+    print(f"[Inspire Pack] The batch({batch_size}) is sampled in micro batches of {micro_batch_size}")
+
+    noise_device = "cpu" if noise_mode == "CPU" else comfy.model_management.get_torch_device()
+    noise = prepare_sampling_noise(latent, seed, noise_device, disable_noise, noise, incremental_seed_mode,
+                                   variation_seed=variation_seed, variation_strength=variation_strength, variation_method=variation_method,
+                                   variation_sweep=variation_sweep)
+
+    results = []
+    for start in range(0, batch_size, micro_batch_size):
+        end = min(start + micro_batch_size, batch_size)
+        sub_latent = {k: slice_batch(v, batch_size, start, end) for k, v in latent.items()}
+
+        samples = inspire_ksampler(model, seed, steps, cfg, sampler_name, scheduler,
+                                   slice_conditioning(positive, batch_size, start, end), slice_conditioning(negative, batch_size, start, end),
+                                   sub_latent, denoise, noise_mode, disable_noise=disable_noise, noise=slice_batch(noise, batch_size, start, end), **kwargs)[0]
+        results.append(samples['samples'])
+
+    samples = latent.copy()
+    samples['samples'] = torch.cat(results)
     return samples, noise
 
 
@@ -86,18 +292,23 @@ class KSampler_inspire:
                      "steps": ("INT", {"default": 20, "min": 1, "max": 10000}),
                      "cfg": ("FLOAT", {"default": 8.0, "min": 0.0, "max": 100.0}),
                      "sampler_name": (comfy.samplers.KSampler.SAMPLERS, ),
-                     "scheduler": (common.SCHEDULERS, ),
+                     "scheduler": (common.KSAMPLER_SCHEDULERS, ),
                      "positive": ("CONDITIONING", ),
                      "negative": ("CONDITIONING", ),
                      "latent_image": ("LATENT", ),
                      "denoise": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.01}),
                      "noise_mode": (["GPU(=A1111)", "CPU"],),
-                     "batch_seed_mode": (["incremental", "comfy", "variation str inc:0.01", "variation str inc:0.05"],),
+                     "batch_seed_mode": (["incremental", "comfy", "variation str inc:0.01", "variation str inc:0.05", "variation sweep"],),
                      "variation_seed": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff}),
                      "variation_strength": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1.0, "step": 0.01}),
                      },
                 "optional":
-                    {"variation_method": (["linear", "slerp"],), }
+                    {
+                        "variation_method": (["linear", "slerp"],),
+                        "variation_sweep": ("STRING", {"multiline": False, "placeholder": "variation sweep strengths (e.g. '0.1, 0.2, 0.3' or '0.0~1.0')"}),
+                        "micro_batch": (["disable", "auto"],),
+                        "result_cache": (["disable", "enable"],),
+                    }
                 }
 
     RETURN_TYPES = ("LATENT",)
@@ -106,9 +317,35 @@ class KSampler_inspire:
     CATEGORY = "InspirePack/a1111_compat"
 
     @staticmethod
-    def doit(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise, noise_mode, batch_seed_mode="comfy", variation_seed=None, variation_strength=None, variation_method="linear"):
-        return (inspire_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise, noise_mode,
-                                 incremental_seed_mode=batch_seed_mode, variation_seed=variation_seed, variation_strength=variation_strength, variation_method=variation_method)[0],)
+    def doit(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise, noise_mode, batch_seed_mode="comfy", variation_seed=None, variation_strength=None, variation_method="linear",
+             variation_sweep=None, micro_batch="disable", result_cache="disable"):
+        key = None
+        if result_cache == "enable":
+            noise_recipe = dict(noise_mode=noise_mode, batch_seed_mode=batch_seed_mode, variation_seed=variation_seed, variation_strength=variation_strength,
+                                variation_method=variation_method, variation_sweep=variation_sweep, micro_batch=micro_batch)
+            key = sampling_cache.make_key(model, positive, negative, latent_image, seed=seed, steps=steps, cfg=cfg, sampler_name=sampler_name,
+                                          scheduler=scheduler, custom_schedule=common.custom_schedules.get(scheduler), denoise=denoise, noise=noise_recipe)
+
+            if key is not None:
+                samples = sampling_cache.cache.get(key)
+                if samples is not None:
+                    latent = latent_image.copy()
+                    latent['samples'] = samples
+                    return (latent,)
+
+        if micro_batch == "auto":
+            sampler = inspire_ksampler_micro_batched
+        else:
+            sampler = inspire_ksampler
+
+        latent = sampler(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise, noise_mode,
+                         incremental_seed_mode=batch_seed_mode, variation_seed=variation_seed, variation_strength=variation_strength, variation_method=variation_method,
+                         variation_sweep=variation_sweep)[0]
+
+        if key is not None:
+            sampling_cache.cache.put(key, latent['samples'])
+
+        return (latent,)
 
 
 class KSamplerAdvanced_inspire:
@@ -121,7 +358,7 @@ class KSamplerAdvanced_inspire:
                      "steps": ("INT", {"default": 20, "min": 1, "max": 10000}),
                      "cfg": ("FLOAT", {"default": 8.0, "min": 0.0, "max": 100.0, "step":0.5, "round": 0.01}),
                      "sampler_name": (comfy.samplers.KSampler.SAMPLERS, ),
-                     "scheduler": (common.SCHEDULERS, ),
+                     "scheduler": (common.KSAMPLER_SCHEDULERS, ),
                      "positive": ("CONDITIONING", ),
                      "negative": ("CONDITIONING", ),
                      "latent_image": ("LATENT", ),
@@ -137,10 +374,12 @@ class KSamplerAdvanced_inspire:
                     {
                         "variation_method": (["linear", "slerp"],),
                         "noise_opt": ("NOISE",),
+                        "early_exit_threshold": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1.0, "step": 0.001}),
                     }
                 }
 
-    RETURN_TYPES = ("LATENT",)
+    RETURN_TYPES = ("LATENT", "INT")
+    RETURN_NAMES = ("LATENT", "steps")
     FUNCTION = "doit"
 
     CATEGORY = "InspirePack/a1111_compat"
@@ -163,8 +402,10 @@ class KSamplerAdvanced_inspire:
                                 force_full_denoise=force_full_denoise, noise_mode=noise_mode, incremental_seed_mode=batch_seed_mode,
                                 variation_seed=variation_seed, variation_strength=variation_strength, noise=noise_opt, callback=callback, variation_method=variation_method)
 
-    def doit(self, *args, **kwargs):
-        return (self.sample(*args, **kwargs)[0],)
+    def doit(self, *args, early_exit_threshold=0.0, **kwargs):
+        monitor = ConvergenceMonitor(early_exit_threshold, kwargs.pop('callback', None))
+        latent = self.sample(*args, callback=monitor, **kwargs)[0]
+        return latent, monitor.steps
 
 
 class KSampler_inspire_pipe:
@@ -176,7 +417,7 @@ class KSampler_inspire_pipe:
                      "steps": ("INT", {"default": 20, "min": 1, "max": 10000}),
                      "cfg": ("FLOAT", {"default": 8.0, "min": 0.0, "max": 100.0}),
                      "sampler_name": (comfy.samplers.KSampler.SAMPLERS, ),
-                     "scheduler": (common.SCHEDULERS, ),
+                     "scheduler": (common.KSAMPLER_SCHEDULERS, ),
                      "latent_image": ("LATENT", ),
                      "denoise": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.01}),
                      "noise_mode": (["GPU(=A1111)", "CPU"],),
@@ -197,6 +438,136 @@ class KSampler_inspire_pipe:
         return latent, vae
 
 
+def conditioning_signature(cond, batch_size):
+    """
+    signature of a conditioning that can be concatenated along the batch axis with the others of the same signature.
+    None if it can't be batched (e.g. multiple areas/entries).
+    """
+    if len(cond) != 1:
+        return None
+
+    c, opts = cond[0]
+    if c.shape[0] not in (1, batch_size):
+        return None
+
+    items = []
+    for k, v in sorted(opts.items()):
+        if isinstance(v, torch.Tensor):
+            if v.shape[0] not in (1, batch_size):
+                return None
+            items.append((k, tuple(v.shape[1:]), v.dtype))
+        else:
+            try:
+                hash(v)
+                items.append((k, v))
+            except TypeError:
+                items.append((k, id(v)))
+
+    return tuple(c.shape[1:]), c.dtype, tuple(items)
+
+
+def concat_conditioning(conds, batch_sizes):
+    def repeat_to(x, batch_size):
+        return x if x.shape[0] == batch_size else x.repeat((batch_size, ) + (1, ) * (x.dim() - 1))
+
+    c = torch.cat([repeat_to(cond[0][0], b) for cond, b in zip(conds, batch_sizes)])
+
+    opts = conds[0][0][1].copy()
+    for k, v in opts.items():
+        if isinstance(v, torch.Tensor):
+            opts[k] = torch.cat([repeat_to(cond[0][1][k], b) for cond, b in zip(conds, batch_sizes)])
+
+    return [[c, opts]]
+
+
+class KSampler_inspire_pipe_batched:
+    @classmethod
+    def INPUT_TYPES(s):
+        inputs = KSampler_inspire_pipe.INPUT_TYPES()
+        inputs["required"]["max_batch_size"] = ("INT", {"default": 8, "min": 1, "max": 4096})
+        return inputs
+
+    INPUT_IS_LIST = True
+
+    RETURN_TYPES = ("LATENT", "VAE")
+    OUTPUT_IS_LIST = (True, True)
+    FUNCTION = "sample"
+
+    CATEGORY = "InspirePack/a1111_compat"
+
+    @staticmethod
+    def sample(basic_pipe, seed, steps, cfg, sampler_name, scheduler, latent_image, denoise, noise_mode, batch_seed_mode, variation_seed, variation_strength, max_batch_size):
+        """
+        list version of `KSampler_inspire_pipe` (e.g. driven by a ZIPPED_PROMPT list).
+        list items with the same model, latent shape, conditioning shapes and sampling parameters are sampled in a single batch
+        and split back into a list. The noise of each item is generated with its own seed, so it is identical to the per-item run.
+        NOTE: samplers that draw extra noise while sampling (ancestral, sde) share it across the batch, so they may differ slightly.
+        """
+        args = basic_pipe, seed, steps, cfg, sampler_name, scheduler, latent_image, denoise, noise_mode, batch_seed_mode, variation_seed, variation_strength
+        max_batch_size = max_batch_size[0]
+        item_cnt = max(len(x) for x in args)
+
+        def item(values, i):
+            return values[i] if i < len(values) else values[-1]
+
+        # group key -> [[index, ...], ...]: the last chunk of a group is filled up to max_batch_size
+        groups = {}
+        for i in range(item_cnt):
+            model, clip, vae, positive, negative = item(basic_pipe, i)
+            latent = item(latent_image, i)
+            samples = latent['samples']
+            batch_size = samples.shape[0]
+
+            pos_signature = conditioning_signature(positive, batch_size)
+            neg_signature = conditioning_signature(negative, batch_size)
+
+            if pos_signature is None or neg_signature is None or 'noise_mask' in latent or 'batch_index' in latent or batch_size >= max_batch_size:
+                key = i
+            else:
+                key = (id(model), tuple(samples.shape[1:]), samples.dtype, pos_signature, neg_signature,
+                       item(steps, i), item(cfg, i), item(sampler_name, i), item(scheduler, i), item(denoise, i), item(noise_mode, i))
+
+            chunks = groups.setdefault(key, [[]])
+            if sum(item(latent_image, x)['samples'].shape[0] for x in chunks[-1]) + batch_size > max_batch_size:
+                chunks.append([])
+            chunks[-1].append(i)
+
+        latents = [None] * item_cnt
+        vaes = [item(basic_pipe, i)[2] for i in range(item_cnt)]
+
+        for chunks in groups.values():
+            for indices in chunks:
+                first = indices[0]
+                model, clip, vae, positive, negative = item(basic_pipe, first)
+
+                if len(indices) == 1:
+                    latents[first] = inspire_ksampler(model, item(seed, first), item(steps, first), item(cfg, first), item(sampler_name, first), item(scheduler, first),
+                                                      positive, negative, item(latent_image, first), item(denoise, first), item(noise_mode, first),
+                                                      incremental_seed_mode=item(batch_seed_mode, first), variation_seed=item(variation_seed, first),
+                                                      variation_strength=item(variation_strength, first))[0]
+                    continue
+
+                noise_device = "cpu" if item(noise_mode, first) == "CPU" else comfy.model_management.get_torch_device()
+                batch_sizes = [item(latent_image, i)['samples'].shape[0] for i in indices]
+
+                noise = torch.cat([utils.prepare_noise(item(latent_image, i)['samples'], item(seed, i), None, noise_device, item(batch_seed_mode, i),
+                                                       variation_seed=item(variation_seed, i), variation_strength=item(variation_strength, i)).to(noise_device)
+                                   for i in indices])
+
+                positive = concat_conditioning([item(basic_pipe, i)[3] for i in indices], batch_sizes)
+                negative = concat_conditioning([item(basic_pipe, i)[4] for i in indices], batch_sizes)
+                latent = {'samples': torch.cat([item(latent_image, i)['samples'] for i in indices])}
+
+                result = inspire_ksampler(model, item(seed, first), item(steps, first), item(cfg, first), item(sampler_name, first), item(scheduler, first),
+                                          positive, negative, latent, item(denoise, first), item(noise_mode, first), noise=noise)[0]
+
+                for i, samples in zip(indices, result['samples'].split(batch_sizes)):
+                    latents[i] = item(latent_image, i).copy()
+                    latents[i]['samples'] = samples
+
+        return latents, vaes
+
+
 class KSamplerAdvanced_inspire_pipe:
     @classmethod
     def INPUT_TYPES(s):
@@ -207,7 +578,7 @@ class KSamplerAdvanced_inspire_pipe:
                      "steps": ("INT", {"default": 20, "min": 1, "max": 10000}),
                      "cfg": ("FLOAT", {"default": 8.0, "min": 0.0, "max": 100.0, "step":0.5, "round": 0.01}),
                      "sampler_name": (comfy.samplers.KSampler.SAMPLERS, ),
-                     "scheduler": (common.SCHEDULERS, ),
+                     "scheduler": (common.KSAMPLER_SCHEDULERS, ),
                      "latent_image": ("LATENT", ),
                      "start_at_step": ("INT", {"default": 0, "min": 0, "max": 10000}),
                      "end_at_step": ("INT", {"default": 10000, "min": 0, "max": 10000}),
@@ -265,48 +636,17 @@ def calc_optimal_hw(hw: int, aspect_ratio: float) -> tuple[int, int]:
     return hcand, wcand
 
 
-def random_divisor(value: int, min_value: int, /, max_options: int = 1, rand_obj=random.Random()) -> int:
-    # print(f"value={value}, min_value={min_value}, max_options={max_options}")
+def get_divisors(value: int, min_value: int, /, max_options: int = 1) -> list[int]:
+    """
+    Returns divisors of value that
+        x * min_value <= value
+    in big -> small order, amount of divisors is limited by max_options
+    """
+    max_options = max(1, max_options)  # at least 1 option should be returned
     min_value = min(min_value, value)
-
-    # All big divisors of value (inclusive)
-    divisors = [i for i in range(min_value, value + 1) if value % i == 0]
-
-    ns = [value // i for i in divisors[:max_options]]  # has at least 1 element
-
-    if len(ns) - 1 > 0:
-        idx = rand_obj.randint(0, len(ns) - 1)
-    else:
-        idx = 0
-    # print(f"ns={ns}, idx={idx}")
-
-    return ns[idx]
-
-# def get_divisors(value: int, min_value: int, /, max_options: int = 1) -> list[int]:
-#     """
-#     Returns divisors of value that
-#         x * min_value <= value
-#     in big -> small order, amount of divisors is limited by max_options
-#     """
-#     max_options = max(1, max_options) # at least 1 option should be returned
-#     min_value = min(min_value, value)
-#     divisors = [i for i in range(min_value, value + 1) if value % i == 0] # divisors in small -> big order
-#     ns = [value // i for i in divisors[:max_options]]  # has at least 1 element # big -> small order
-#     return ns
-
-
-# def random_divisor(value: int, min_value: int, /, max_options: int = 1, rand_obj=None) -> int:
-#     """
-#     Returns a random divisor of value that
-#         x * min_value <= value
-#     if max_options is 1, the behavior is deterministic
-#     """
-#     print(f"value={value}, min_value={min_value}, max_options={max_options}")
-#     ns = get_divisors(value, min_value, max_options=max_options) # get cached divisors
-#     idx = rand_obj.randint(0, len(ns) - 1)
-#     print(f"ns={ns}, idx={idx}")
-#
-#     return ns[idx]
+    divisors = [i for i in range(min_value, value + 1) if value % i == 0]  # divisors in small -> big order
+    ns = [value // i for i in divisors[:max_options]]  # has at least 1 element # big -> small order
+    return ns
 
 
 class HyperTileInspire:
@@ -331,37 +671,38 @@ class HyperTileInspire:
         rand_obj = random.Random()
         rand_obj.seed(seed)
 
-        def hypertile_in(q, k, v, extra_options):
-            nonlocal temp
-            model_chans = q.shape[-2]
-            orig_shape = extra_options['original_shape']
-            apply_to = []
-            for i in range(max_depth + 1):
-                apply_to.append((orig_shape[-2] / (2 ** i)) * (orig_shape[-1] / (2 ** i)))
+        # tile plans are computed once per (tokens, latent shape): (h, w, nh options, nw options) or None
+        plans = {}
+
+        def get_plan(hw, orig_shape):
+            key = hw, orig_shape[-2], orig_shape[-1]
+            if key not in plans:
+                plan = None
+                for depth in range(max_depth + 1):
+                    if hw == (orig_shape[-2] / (2 ** depth)) * (orig_shape[-1] / (2 ** depth)):
+                        aspect_ratio = orig_shape[-1] / orig_shape[-2]
+                        h, w = round(math.sqrt(hw * aspect_ratio)), round(math.sqrt(hw / aspect_ratio))
+
+                        factor = (2 ** depth) if scale_depth else 1
+                        plan = h, w, get_divisors(h, latent_tile_size * factor, swap_size), get_divisors(w, latent_tile_size * factor, swap_size)
+                        break
 
-            if model_chans in apply_to:
-                shape = extra_options["original_shape"]
-                aspect_ratio = shape[-1] / shape[-2]
+                plans[key] = plan
 
-                hw = q.size(1)
-                # h, w = calc_optimal_hw(hw, aspect_ratio)
-                h, w = round(math.sqrt(hw * aspect_ratio)), round(math.sqrt(hw / aspect_ratio))
+            return plans[key]
 
-                factor = (2 ** apply_to.index(model_chans)) if scale_depth else 1
-                nh = random_divisor(h, latent_tile_size * factor, swap_size, rand_obj)
-                nw = random_divisor(w, latent_tile_size * factor, swap_size, rand_obj)
+        def hypertile_in(q, k, v, extra_options):
+            nonlocal temp
+            plan = get_plan(q.shape[-2], extra_options['original_shape'])
 
-                print(f"factor: {factor} <--- params.depth: {apply_to.index(model_chans)} / scale_depth: {scale_depth} / latent_tile_size={latent_tile_size}")
-                # print(f"h: {h}, w:{w} --> nh: {nh}, nw: {nw}")
+            if plan is not None:
+                h, w, nh_options, nw_options = plan
+                nh = nh_options[rand_obj.randint(0, len(nh_options) - 1)] if len(nh_options) > 1 else nh_options[0]
+                nw = nw_options[rand_obj.randint(0, len(nw_options) - 1)] if len(nw_options) > 1 else nw_options[0]
 
                 if nh * nw > 1:
                     q = rearrange(q, "b (nh h nw w) c -> (b nh nw) (h w) c", h=h // nh, w=w // nw, nh=nh, nw=nw)
                     temp = (nh, nw, h, w)
-                # else:
-                #     temp = None
-
-                print(f"q={q} / k={k} / v={v}")
-                return q, k, v
 
             return q, k, v
 
@@ -385,6 +726,7 @@ NODE_CLASS_MAPPINGS = {
     "KSamplerAdvanced //Inspire": KSamplerAdvanced_inspire,
     "KSamplerPipe //Inspire": KSampler_inspire_pipe,
     "KSamplerAdvancedPipe //Inspire": KSamplerAdvanced_inspire_pipe,
+    "KSamplerPipeBatched //Inspire": KSampler_inspire_pipe_batched,
     "RandomNoise //Inspire": RandomNoise,
     "HyperTile //Inspire": HyperTileInspire
 }
@@ -393,6 +735,7 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "KSamplerAdvanced //Inspire": "KSamplerAdvanced (inspire)",
     "KSamplerPipe //Inspire": "KSampler [pipe] (inspire)",
     "KSamplerAdvancedPipe //Inspire": "KSamplerAdvanced [pipe] (inspire)",
+    "KSamplerPipeBatched //Inspire": "KSampler [pipe, batched] (inspire)",
     "RandomNoise //Inspire": "RandomNoise (inspire)",
     "HyperTile //Inspire": "HyperTile (Inspire)"
 }
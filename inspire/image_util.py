@@ -1,14 +1,334 @@
+import hashlib
+import json
+import math
 import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 from PIL import ImageOps
 import comfy
 import folder_paths
-import base64
+import binascii
 from io import BytesIO
 from .libs.utils import *
 
 
+# directory -> (directory mtime, scan time, sorted image file paths)
+image_dir_cache = {}
+
+
+def scan_image_dir(directory):
+    """
+    sorted image files of the directory. the scan is cached until the directory mtime changes
+    (adding, removing or renaming files changes it, modifying a file in place doesn't change the list).
+    """
+    if not os.path.isdir(directory):
+        raise FileNotFoundError(f"Directory '{directory}' cannot be found.")
+
+    dir_mtime = os.stat(directory).st_mtime_ns
+    cached = image_dir_cache.get(directory)
+
+    # NOTE: the mtime resolution of some filesystems is coarse, so a scan done right after a change isn't trusted
+    if cached is not None and cached[0] == dir_mtime and cached[1] - dir_mtime > 2 * 10**9:
+        return cached[2]
+
+    scan_time = time.time_ns()
+
+    valid_extensions = ('.jpg', '.jpeg', '.png', '.webp')
+    with os.scandir(directory) as it:
+        dir_files = [entry.name for entry in it if entry.name.lower().endswith(valid_extensions) and not entry.is_dir()]
+
+    dir_files = [os.path.join(directory, x) for x in sorted(dir_files)]
+    image_dir_cache[directory] = dir_mtime, scan_time, dir_files
+
+    return dir_files
+
+
+def list_image_files(directory, start_index=0, image_load_cap=0):
+    dir_files = scan_image_dir(directory)
+    if len(dir_files) == 0 and len(os.listdir(directory)) == 0:
+        raise FileNotFoundError(f"No files in directory '{directory}'.")
+
+    # start at start_index
+    dir_files = dir_files[start_index:]
+
+    if image_load_cap > 0:
+        dir_files = dir_files[:image_load_cap]
+
+    return dir_files
+
+
+def image_dir_signature(directory, start_index=0, image_load_cap=0):
+    """
+    content signature of the images to be loaded: their paths, mtimes and sizes
+    """
+    try:
+        dir_files = list_image_files(directory, start_index, image_load_cap)
+    except FileNotFoundError:
+        return f"not found: {directory}"
+
+    h = hashlib.sha256()
+    for path in dir_files:
+        try:
+            stat = os.stat(path)
+            h.update(f"{path}:{stat.st_mtime_ns}:{stat.st_size};".encode())
+        except OSError:
+            h.update(f"{path}:missing;".encode())
+
+    return h.hexdigest()
+
+
+DECODED_IMAGE_CACHE_SIZE = 1024 ** 3  # bytes
+
+
+class DecodedImageCache:
+    """
+    LRU cache of the decoded uint8 images (image, alpha), bounded by bytes.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.total_bytes = 0
+
+    @staticmethod
+    def entry_size(image, alpha):
+        return image.numel() + (alpha.numel() if alpha is not None else 0)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None:
+                self.data.move_to_end(key)
+            return entry
+
+    def put(self, key, image, alpha):
+        size = self.entry_size(image, alpha)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.data:
+                return
+
+            self.data[key] = image, alpha
+            self.total_bytes += size
+
+            while self.total_bytes > self.max_bytes:
+                _, old_entry = self.data.popitem(last=False)
+                self.total_bytes -= self.entry_size(*old_entry)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.total_bytes = 0
+
+
+decoded_image_cache = DecodedImageCache(DECODED_IMAGE_CACHE_SIZE)
+
+
+def reduce_pil_image(i, target_size):
+    """
+    downscales the image so that its longer side is `target_size`, while decoding:
+    JPEG is decoded at a reduced scale in the DCT domain (draft), the other formats are reduced by an integer factor (reduce).
+    only the remaining (small) resize is done by resampling.
+    """
+    scale = target_size / max(i.size)
+    if scale >= 1:
+        return i
+
+    if i.format == 'JPEG':
+        # draft picks the smallest DCT scale (1/2, 1/4, 1/8) that is still >= the requested size
+        i.draft('RGB', (math.ceil(i.width * scale), math.ceil(i.height * scale)))
+
+    if i.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        i = i.convert('RGBA' if 'A' in i.getbands() else 'RGB')
+
+    factor = int(max(i.size) / target_size)
+    if factor >= 2:
+        i = i.reduce(factor)
+
+    size = max(1, round(i.width * target_size / max(i.size))), max(1, round(i.height * target_size / max(i.size)))
+    if size != i.size:
+        i = i.resize(size, Image.LANCZOS)
+
+    return i
+
+
+def decode_pil_image(i, target_size=0):
+    """
+    returns (image uint8 [H,W,3], alpha uint8 [H,W] or None)
+    the images stay uint8 until they are written to the output, which is converted to float at once.
+    target_size: if > 0, the image is downscaled to fit its longer side to it while decoding.
+    """
+    if target_size > 0:
+        i = reduce_pil_image(i, target_size)
+
+    i = ImageOps.exif_transpose(i)
+    image = torch.from_numpy(np.array(i.convert("RGB")))
+
+    if 'A' in i.getbands():
+        alpha = torch.from_numpy(np.array(i.getchannel('A')))
+    else:
+        alpha = None
+
+    return image, alpha
+
+
+def to_image_tensors(image, alpha, dtype=torch.float32):
+    """
+    uint8 (image, alpha) -> (image [1,H,W,3], mask [H,W])
+    """
+    image = image[None,].to(dtype).div_(255.0)
+
+    if alpha is not None:
+        mask = alpha.to(dtype).div_(255.0).neg_().add_(1.0)
+    else:
+        mask = torch.zeros((64, 64), dtype=dtype, device="cpu")
+
+    return image, mask
+
+
+def load_image_file(image_path, target_size=0):
+    """
+    returns uint8 (image [H,W,3], alpha [H,W] or None), cached by (path, mtime, size, target_size)
+    """
+    stat = os.stat(image_path)
+    key = image_path, stat.st_mtime_ns, stat.st_size, target_size
+
+    cached = decoded_image_cache.get(key)
+    if cached is not None:
+        return cached
+
+    image, alpha = decode_pil_image(Image.open(image_path), target_size)
+    decoded_image_cache.put(key, image, alpha)
+    return image, alpha
+
+
+def parallel_map(func, items, workers=0):
+    """
+    runs func over items in a thread pool (PIL releases the GIL while decoding), the order of `items` is kept.
+    the workers run in the inference mode of the caller, so they can write into the tensors allocated by the node.
+    workers: 0 means the number of CPUs
+    """
+    items = list(items)
+
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+
+    workers = min(workers, len(items))
+
+    if workers <= 1:
+        return [func(x) for x in items]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(with_caller_inference_mode(func), items))
+
+
+FRAME_CACHE_NAME = ".inspire_frames"
+
+
+def build_frame_cache(directory, dir_files, signature, workers=0, target_size=0):
+    """
+    decodes all the frames of the directory into a uint8 `.npy` file [N,H,W,3 or 4] in the directory.
+    the frames are normalized to the size of the first frame, the 4th channel (alpha) exists only if some frame has alpha.
+    """
+    npy_path = os.path.join(directory, f"{FRAME_CACHE_NAME}.npy")
+    meta_path = os.path.join(directory, f"{FRAME_CACHE_NAME}.json")
+
+    print(f"[Inspire Pack] LoadImagesFromDir: building frame cache of '{directory}' ({len(dir_files)} frames)")
+
+    # alpha is detected from the header, without decoding
+    alpha_indices = []
+    for index, path in enumerate(dir_files):
+        with Image.open(path) as i:
+            if 'A' in i.getbands():
+                alpha_indices.append(index)
+
+    first_image, _ = decode_pil_image(Image.open(dir_files[0]), target_size)
+    height, width, _ = first_image.shape
+    channels = 4 if len(alpha_indices) > 0 else 3
+
+    temp_path = f"{npy_path}.{os.getpid()}.tmp"
+    frames = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.uint8, shape=(len(dir_files), height, width, channels))
+
+    def resize(x):
+        x = comfy.utils.common_upscale(x.movedim(-1, 1).float(), width, height, "bilinear", "center").movedim(1, -1)
+        return x.round().clamp(0, 255).to(torch.uint8)
+
+    def write(index):
+        image, alpha = decode_pil_image(Image.open(dir_files[index]), target_size)
+        if image.shape != first_image.shape:
+            image = resize(image[None,])[0]
+            if alpha is not None:
+                alpha = resize(alpha[None, :, :, None])[0, :, :, 0]
+
+        frames[index, :, :, :3] = image.numpy()
+        if channels == 4:
+            frames[index, :, :, 3] = alpha.numpy() if alpha is not None else 255
+
+    parallel_map(write, range(len(dir_files)), workers)
+
+    frames.flush()
+    del frames
+    os.replace(temp_path, npy_path)
+
+    with open(meta_path, 'w') as f:
+        json.dump({"signature": signature, "target_size": target_size, "alpha_indices": alpha_indices}, f)
+
+
+def load_frame_cache(directory, start_index=0, image_load_cap=0, workers=0, dtype=torch.float32, target_size=0):
+    """
+    slices the frames from the memory-mapped frame cache of the directory, (re)building it if the directory is changed.
+    """
+    npy_path = os.path.join(directory, f"{FRAME_CACHE_NAME}.npy")
+    meta_path = os.path.join(directory, f"{FRAME_CACHE_NAME}.json")
+
+    dir_files = list_image_files(directory)
+    if len(dir_files) == 0:
+        raise FileNotFoundError(f"No image files in directory '{directory}'.")
+
+    signature = image_dir_signature(directory)
+
+    meta = None
+    if os.path.exists(npy_path) and os.path.exists(meta_path):
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except Exception:
+            meta = None
+
+    if meta is None or meta.get('signature') != signature or meta.get('target_size', 0) != target_size:
+        build_frame_cache(directory, dir_files, signature, workers, target_size)
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+    # copy-on-write mapping: the frames are read from the page cache, and the mapping stays writable for torch
+    frames = np.load(npy_path, mmap_mode='c')
+
+    end_index = len(frames) if image_load_cap <= 0 else start_index + image_load_cap
+    frames = frames[start_index:end_index]
+    count = len(frames)
+
+    if count == 0:
+        raise FileNotFoundError(f"No image files in directory '{directory}' from index {start_index}.")
+
+    images = torch.from_numpy(frames[..., :3]).to(dtype).div_(255.0)
+
+    if any(start_index <= x < start_index + count for x in meta['alpha_indices']):
+        masks = torch.from_numpy(frames[..., 3]).to(dtype).div_(255.0).neg_().add_(1.0)
+    else:
+        masks = torch.zeros((count, 64, 64), dtype=dtype)
+
+    if count == 1:
+        masks = masks[0]
+
+    return images, masks, count
+
+
 class LoadImagesFromDirBatch:
     @classmethod
     def INPUT_TYPES(s):
@@ -20,6 +340,10 @@ class LoadImagesFromDirBatch:
                 "image_load_cap": ("INT", {"default": 0, "min": 0, "step": 1}),
                 "start_index": ("INT", {"default": 0, "min": 0, "step": 1}),
                 "load_always": ("BOOLEAN", {"default": False, "label_on": "enabled", "label_off": "disabled"}),
+                "decode_workers": ("INT", {"default": 0, "min": 0, "max": 64, "step": 1}),
+                "half_precision": ("BOOLEAN", {"default": False, "label_on": "enabled", "label_off": "disabled"}),
+                "frame_cache": ("BOOLEAN", {"default": False, "label_on": "enabled", "label_off": "disabled"}),
+                "target_size": ("INT", {"default": 0, "min": 0, "max": 16384, "step": 1}),
             }
         }
 
@@ -33,83 +357,56 @@ class LoadImagesFromDirBatch:
         if 'load_always' in kwargs and kwargs['load_always']:
             return float("NaN")
         else:
-            return hash(frozenset(kwargs))
+            return image_dir_signature(kwargs.get('directory', ''), kwargs.get('start_index', 0), kwargs.get('image_load_cap', 0))
 
-    def load_images(self, directory: str, image_load_cap: int = 0, start_index: int = 0, load_always=False):
-        if not os.path.isdir(directory):
-            raise FileNotFoundError(f"Directory '{directory} cannot be found.'")
-        dir_files = os.listdir(directory)
-        if len(dir_files) == 0:
-            raise FileNotFoundError(f"No files in directory '{directory}'.")
-
-        # Filter files by extension
-        valid_extensions = ['.jpg', '.jpeg', '.png', '.webp']
-        dir_files = [f for f in dir_files if any(f.lower().endswith(ext) for ext in valid_extensions)]
-
-        dir_files = sorted(dir_files)
-        dir_files = [os.path.join(directory, x) for x in dir_files]
-
-        # start at start_index
-        dir_files = dir_files[start_index:]
-
-        images = []
-        masks = []
-
-        limit_images = False
-        if image_load_cap > 0:
-            limit_images = True
-        image_count = 0
-
-        has_non_empty_mask = False
-
-        for image_path in dir_files:
-            if os.path.isdir(image_path) and os.path.ex:
-                continue
-            if limit_images and image_count >= image_load_cap:
-                break
-            i = Image.open(image_path)
-            i = ImageOps.exif_transpose(i)
-            image = i.convert("RGB")
-            image = np.array(image).astype(np.float32) / 255.0
-            image = torch.from_numpy(image)[None,]
-            if 'A' in i.getbands():
-                mask = np.array(i.getchannel('A')).astype(np.float32) / 255.0
-                mask = 1. - torch.from_numpy(mask)
-                has_non_empty_mask = True
-            else:
-                mask = torch.zeros((64, 64), dtype=torch.float32, device="cpu")
-            images.append(image)
-            masks.append(mask)
-            image_count += 1
+    def load_images(self, directory: str, image_load_cap: int = 0, start_index: int = 0, load_always=False, decode_workers=0, half_precision=False,
+                    frame_cache=False, target_size=0):
+        dtype = torch.float16 if half_precision else torch.float32
 
-        if len(images) == 1:
-            return (images[0], masks[0], 1)
+        if frame_cache:
+            return load_frame_cache(directory, start_index, image_load_cap, decode_workers, dtype, target_size)
 
-        elif len(images) > 1:
-            image1 = images[0]
-            mask1 = None
+        dir_files = list_image_files(directory, start_index, image_load_cap)
 
-            for image2 in images[1:]:
-                if image1.shape[1:] != image2.shape[1:]:
-                    image2 = comfy.utils.common_upscale(image2.movedim(-1, 1), image1.shape[2], image1.shape[1], "bilinear", "center").movedim(1, -1)
-                image1 = torch.cat((image1, image2), dim=0)
-
-            for mask2 in masks[1:]:
-                if has_non_empty_mask:
-                    if image1.shape[1:3] != mask2.shape:
-                        mask2 = torch.nn.functional.interpolate(mask2.unsqueeze(0).unsqueeze(0), size=(image1.shape[2], image1.shape[1]), mode='bilinear', align_corners=False)
-                        mask2 = mask2.squeeze(0)
-                    else:
-                        mask2 = mask2.unsqueeze(0)
-                else:
-                    mask2 = mask2.unsqueeze(0)
-
-                if mask1 is None:
-                    mask1 = mask2
-                else:
-                    mask1 = torch.cat((mask1, mask2), dim=0)
+        if len(dir_files) == 0:
+            raise FileNotFoundError(f"No image files in directory '{directory}'.")
+
+        first_image, first_alpha = load_image_file(dir_files[0], target_size)
+
+        if len(dir_files) == 1:
+            image, mask = to_image_tensors(first_image, first_alpha, dtype)
+            return (image, mask, 1)
+
+        # the batch is allocated once with the size of the first image, and each image is written directly into its slot.
+        # the slots hold 0..255 values, which are normalized in a single pass at the end.
+        height, width, _ = first_image.shape
+        images = torch.empty((len(dir_files), height, width, 3), dtype=dtype)
+        images[0].copy_(first_image)
+
+        def load(index):
+            image, alpha = load_image_file(dir_files[index], target_size)
+            if image.shape != first_image.shape:
+                # NOTE: the alpha is resized (center crop + scale) in the same way as the image, so the mask stays aligned with the pixels
+                image = comfy.utils.common_upscale(image[None,].movedim(-1, 1).float(), width, height, "bilinear", "center").movedim(1, -1)[0]
+                if alpha is not None:
+                    alpha = comfy.utils.common_upscale(alpha[None, None].float(), width, height, "bilinear", "center")[0, 0]
+            images[index].copy_(image)
+            return alpha
+
+        alphas = [first_alpha] + parallel_map(load, range(1, len(dir_files)), decode_workers)
+        images.div_(255.0)
+
+        if any(alpha is not None for alpha in alphas):
+            # an image without alpha is fully opaque (mask 0)
+            masks = torch.full((len(dir_files), height, width), 255.0, dtype=dtype)
+            for index, alpha in enumerate(alphas):
+                if alpha is not None:
+                    masks[index].copy_(alpha)
+            masks.div_(255.0).neg_().add_(1.0)
+        else:
+            masks = torch.zeros((len(dir_files), 64, 64), dtype=dtype)
 
-            return (image1, mask1, len(images))
+        return (images, masks, len(dir_files))
 
 
 class LoadImagesFromDirList:
@@ -123,6 +420,9 @@ class LoadImagesFromDirList:
                 "image_load_cap": ("INT", {"default": 0, "min": 0, "step": 1}),
                 "start_index": ("INT", {"default": 0, "min": 0, "step": 1}),
                 "load_always": ("BOOLEAN", {"default": False, "label_on": "enabled", "label_off": "disabled"}),
+                "decode_workers": ("INT", {"default": 0, "min": 0, "max": 64, "step": 1}),
+                "half_precision": ("BOOLEAN", {"default": False, "label_on": "enabled", "label_off": "disabled"}),
+                "target_size": ("INT", {"default": 0, "min": 0, "max": 16384, "step": 1}),
             }
         }
 
@@ -138,55 +438,75 @@ class LoadImagesFromDirList:
         if 'load_always' in kwargs and kwargs['load_always']:
             return float("NaN")
         else:
-            return hash(frozenset(kwargs))
+            return image_dir_signature(kwargs.get('directory', ''), kwargs.get('start_index', 0), kwargs.get('image_load_cap', 0))
 
-    def load_images(self, directory: str, image_load_cap: int = 0, start_index: int = 0, load_always=False):
-        if not os.path.isdir(directory):
-            raise FileNotFoundError(f"Directory '{directory}' cannot be found.")
-        dir_files = os.listdir(directory)
-        if len(dir_files) == 0:
-            raise FileNotFoundError(f"No files in directory '{directory}'.")
+    def load_images(self, directory: str, image_load_cap: int = 0, start_index: int = 0, load_always=False, decode_workers=0, half_precision=False,
+                    target_size=0):
+        dtype = torch.float16 if half_precision else torch.float32
+        dir_files = list_image_files(directory, start_index, image_load_cap)
 
-        # Filter files by extension
-        valid_extensions = ['.jpg', '.jpeg', '.png', '.webp']
-        dir_files = [f for f in dir_files if any(f.lower().endswith(ext) for ext in valid_extensions)]
+        loaded = parallel_map(lambda x: to_image_tensors(*load_image_file(x, target_size), dtype), dir_files, decode_workers)
 
-        dir_files = sorted(dir_files)
-        dir_files = [os.path.join(directory, x) for x in dir_files]
+        images = [x[0] for x in loaded]
+        masks = [x[1] for x in loaded]
 
-        # start at start_index
-        dir_files = dir_files[start_index:]
+        return images, masks
 
-        images = []
-        masks = []
 
-        limit_images = False
-        if image_load_cap > 0:
-            limit_images = True
-        image_count = 0
-
-        for image_path in dir_files:
-            if os.path.isdir(image_path) and os.path.ex:
-                continue
-            if limit_images and image_count >= image_load_cap:
-                break
-            i = Image.open(image_path)
-            i = ImageOps.exif_transpose(i)
-            image = i.convert("RGB")
-            image = np.array(image).astype(np.float32) / 255.0
-            image = torch.from_numpy(image)[None,]
+load_image_stream_cursors = {}
 
-            if 'A' in i.getbands():
-                mask = np.array(i.getchannel('A')).astype(np.float32) / 255.0
-                mask = 1. - torch.from_numpy(mask)
-            else:
-                mask = torch.zeros((64, 64), dtype=torch.float32, device="cpu")
 
-            images.append(image)
-            masks.append(mask)
-            image_count += 1
+class LoadImagesFromDirStream:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "directory": ("STRING", {"default": ""}),
+                "chunk_size": ("INT", {"default": 16, "min": 1, "max": 4096, "step": 1}),
+                "start_index": ("INT", {"default": 0, "min": 0, "step": 1}),
+            },
+            "optional": {
+                "decode_workers": ("INT", {"default": 0, "min": 0, "max": 64, "step": 1}),
+                "half_precision": ("BOOLEAN", {"default": False, "label_on": "enabled", "label_off": "disabled"}),
+                "target_size": ("INT", {"default": 0, "min": 0, "max": 16384, "step": 1}),
+            },
+            "hidden": {"unique_id": "UNIQUE_ID"},
+        }
 
-        return images, masks
+    RETURN_TYPES = ("IMAGE", "MASK", "INT", "BOOLEAN")
+    RETURN_NAMES = ("image", "mask", "index", "is_last")
+    FUNCTION = "load_images"
+
+    CATEGORY = "image"
+
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        # every execution emits the next chunk
+        return float("NaN")
+
+    def load_images(self, directory: str, chunk_size: int, start_index: int, decode_workers=0, half_precision=False, target_size=0, unique_id=None):
+        """
+        emits the next `chunk_size` images of the directory on each execution, and restarts from `start_index` after the last chunk.
+        """
+        key = unique_id, directory, start_index
+        cursor = load_image_stream_cursors.get(key, 0)
+
+        file_count = len(list_image_files(directory, start_index))
+        if cursor >= file_count:
+            cursor = 0
+
+        index = start_index + cursor
+        images, masks, count = LoadImagesFromDirBatch().load_images(directory, image_load_cap=chunk_size, start_index=index, decode_workers=decode_workers,
+                                                                     half_precision=half_precision, target_size=target_size)
+
+        cursor += count
+        is_last = cursor >= file_count
+        load_image_stream_cursors[key] = 0 if is_last else cursor
+
+        if len(masks.shape) == 2:
+            masks = masks.unsqueeze(0)
+
+        return (images, masks, index, is_last)
 
 
 class LoadImageInspire:
@@ -206,17 +526,22 @@ class LoadImageInspire:
     FUNCTION = "load_image"
 
     def load_image(self, image, image_data):
-        image_data = base64.b64decode(image_data.split(",")[1])
-        i = Image.open(BytesIO(image_data))
-        i = ImageOps.exif_transpose(i)
-        image = i.convert("RGB")
-        image = np.array(image).astype(np.float32) / 255.0
-        image = torch.from_numpy(image)[None,]
-        if 'A' in i.getbands():
-            mask = np.array(i.getchannel('A')).astype(np.float32) / 255.0
-            mask = 1. - torch.from_numpy(mask)
+        # NOTE: the data url is encoded only once, then hashed and base64-decoded through a memoryview without further copies.
+        #       (the image is forced to "#DATA" by onprompt, so the decoded image is cached by the hash of image_data instead of the file name)
+        raw = memoryview(image_data.encode('ascii'))
+        payload = raw[raw.obj.find(b',') + 1:]
+
+        key = 'data', hashlib.sha256(payload).hexdigest()
+
+        cached = decoded_image_cache.get(key)
+        if cached is not None:
+            image, alpha = cached
         else:
-            mask = torch.zeros((64, 64), dtype=torch.float32, device="cpu")
+            data = binascii.a2b_base64(payload)
+            image, alpha = decode_pil_image(Image.open(BytesIO(data)))
+            decoded_image_cache.put(key, image, alpha)
+
+        image, mask = to_image_tensors(image, alpha)
         return (image, mask.unsqueeze(0))
 
 
@@ -354,12 +679,13 @@ class LatentBatchSplitter:
         return tuple(res)
 
 
-def top_k_colors(image_tensor, k, min_pixels):
-    flattened_image = image_tensor.view(-1, image_tensor.size(-1))
-
-    unique_colors, counts = torch.unique(flattened_image, dim=0, return_counts=True)
+def top_k_colors(packed_colors, k, min_pixels):
+    """
+    the k most frequent colors (24-bit packed) that have at least min_pixels pixels, in descending order of frequency
+    """
+    unique_colors, counts = torch.unique(packed_colors.reshape(-1), return_counts=True)
 
-    sorted_counts, sorted_indices = torch.sort(counts, descending=True)
+    sorted_counts, sorted_indices = torch.sort(counts, descending=True, stable=True)
     sorted_colors = unique_colors[sorted_indices]
 
     filtered_colors = sorted_colors[sorted_counts >= min_pixels]
@@ -367,12 +693,6 @@ def top_k_colors(image_tensor, k, min_pixels):
     return filtered_colors[:k]
 
 
-def create_mask(image_tensor, color):
-    mask_tensor = torch.zeros_like(image_tensor[:, :, :, 0])
-    mask_tensor = torch.where(torch.all(image_tensor == color, dim=-1, keepdim=False), 1, mask_tensor)
-    return mask_tensor
-
-
 class ColorMapToMasks:
     @classmethod
     def INPUT_TYPES(s):
@@ -389,25 +709,19 @@ class ColorMapToMasks:
     CATEGORY = "InspirePack/Util"
 
     def doit(self, color_map, max_count, min_pixels):
-        if len(color_map) > 0:
-            print(f"[Inspire Pack] WARN: ColorMapToMasks - Sure, here's the translation: `color_map` can only be a single image. Only the first image will be processed. If you want to utilize the remaining images, convert the Image Batch to an Image List.")
+        # colors are compared as 24-bit ints (0xRRGGBB), and all masks of an image are made by a single comparison
+        packed_color_map = pack_rgb(color_map)
 
-        top_colors = top_k_colors(color_map[0], max_count, min_pixels)
-
-        masks = None
-
-        for color in top_colors:
-            this_mask = create_mask(color_map, color)
-            if masks is None:
-                masks = this_mask
-            else:
-                masks = torch.concat((masks, this_mask), dim=0)
+        masks = []
+        for packed_colors in packed_color_map:
+            top_colors = top_k_colors(packed_colors, max_count, min_pixels)
+            if len(top_colors) > 0:
+                masks.append((packed_colors.unsqueeze(0) == top_colors[:, None, None]).float())
 
-        if masks is None:
-            masks = torch.zeros_like(color_map[0, :, :, 0])
-            masks.unsqueeze(0)
+        if len(masks) == 0:
+            return (torch.zeros_like(color_map[:1, :, :, 0]),)
 
-        return (masks,)
+        return (torch.cat(masks, dim=0),)
 
 
 class SelectNthMask:
@@ -430,6 +744,7 @@ class SelectNthMask:
 NODE_CLASS_MAPPINGS = {
     "LoadImagesFromDir //Inspire": LoadImagesFromDirBatch,
     "LoadImageListFromDir //Inspire": LoadImagesFromDirList,
+    "LoadImagesFromDirStream //Inspire": LoadImagesFromDirStream,
     "LoadImage //Inspire": LoadImageInspire,
     "ChangeImageBatchSize //Inspire": ChangeImageBatchSize,
     "ChangeLatentBatchSize //Inspire": ChangeLatentBatchSize,
@@ -442,6 +757,7 @@ NODE_CLASS_MAPPINGS = {
 NODE_DISPLAY_NAME_MAPPINGS = {
     "LoadImagesFromDir //Inspire": "Load Image Batch From Dir (Inspire)",
     "LoadImageListFromDir //Inspire": "Load Image List From Dir (Inspire)",
+    "LoadImagesFromDirStream //Inspire": "Load Image Stream From Dir (Inspire)",
     "LoadImage //Inspire": "Load Image (Inspire)",
     "ChangeImageBatchSize //Inspire": "Change Image Batch Size (Inspire)",
     "ChangeLatentBatchSize //Inspire": "Change Latent Batch Size (Inspire)",
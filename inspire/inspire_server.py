@@ -6,6 +6,8 @@ from enum import Enum
 from . import prompt_support
 from aiohttp import web
 from . import backend_support
+from .libs import sampler_stats
+from .libs import sampling_cache
 
 
 max_seed = 2**32 - 1
@@ -53,6 +55,23 @@ async def set_cache_settings(request):
         return web.Response(text=f"{e}", status=500)
 
 
+@server.PromptServer.instance.routes.get("/inspire/stats/sampler")
+def stats_sampler(request):
+    return web.json_response(sampler_stats.stats.get_data())
+
+
+@server.PromptServer.instance.routes.get("/inspire/stats/sampler/clear")
+def stats_sampler_clear(request):
+    sampler_stats.stats.clear()
+    return web.Response(status=200)
+
+
+@server.PromptServer.instance.routes.get("/inspire/sampling_cache/clear")
+def sampling_cache_clear(request):
+    sampling_cache.cache.clear()
+    return web.Response(status=200)
+
+
 class SGmode(Enum):
     FIX = 1
     INCR = 2
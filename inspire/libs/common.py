@@ -1,14 +1,135 @@
+import inspect
+import os
+
 import comfy
 import nodes
+import numpy as np
+import torch
 from . import utils
 
 SCHEDULERS = comfy.samplers.KSampler.SCHEDULERS + ['AYS SDXL', 'AYS SD1', 'AYS SVD']
 
 
+def load_custom_schedules(filename):
+    """
+    Each line is `name:sigma1,sigma2,...` (high -> low noise levels).
+    The noise levels are log-linear interpolated to the number of steps, like AYS.
+    """
+    path = os.path.join(os.path.dirname(__file__), "..", "..", "resources", filename)
+    path = os.path.abspath(path)
+    schedules = {}
+
+    if not os.path.exists(path):
+        return schedules
+
+    with open(path, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+
+            try:
+                name, values = line.split(':', 1)
+                schedules[f"CUSTOM {name.strip()}"] = [float(x) for x in values.split(',')]
+            except Exception:
+                print(f"[Inspire Pack] WARN: invalid custom sigma schedule '{line}' in '{filename}' - ignored")
+
+    return schedules
+
+
+custom_schedules = load_custom_schedules("sigma-schedules.custom.txt")
+
+# schedulers of the `KSampler //Inspire` family (these are computed by Inspire Pack itself)
+KSAMPLER_SCHEDULERS = SCHEDULERS + list(custom_schedules.keys())
+
+try:
+    from cachetools import LRUCache
+    sigmas_cache = LRUCache(maxsize=256)
+except (ImportError, ModuleNotFoundError):
+    sigmas_cache = {}
+
+
+def loglinear_interp(t_steps, num_steps):
+    xs = np.linspace(0, 1, len(t_steps))
+    ys = np.log(t_steps[::-1])
+
+    new_xs = np.linspace(0, 1, num_steps)
+    new_ys = np.interp(new_xs, xs, ys)
+
+    return np.exp(new_ys)[::-1].copy()
+
+
+def model_sampling_key(model_sampling):
+    sigmas = getattr(model_sampling, 'sigmas', None)
+    if sigmas is not None:
+        sigmas = len(sigmas), float(sigmas[len(sigmas) // 2])
+
+    return type(model_sampling).__name__, float(model_sampling.sigma_min), float(model_sampling.sigma_max), sigmas
+
+
+def _calculate_sigmas(model_sampling, scheduler, steps):
+    if scheduler in custom_schedules:
+        sigmas = custom_schedules[scheduler]
+        if (steps + 1) != len(sigmas):
+            sigmas = loglinear_interp(sigmas, steps + 1)
+        sigmas = np.array(sigmas, dtype=np.float32)
+        sigmas[-1] = 0
+        return torch.from_numpy(sigmas)
+
+    elif scheduler.startswith('AYS '):
+        if 'AlignYourStepsScheduler' not in nodes.NODE_CLASS_MAPPINGS:
+            raise Exception(f"[ERROR] '{scheduler}' scheduler requires the 'AlignYourStepsScheduler' node. Please update ComfyUI.")
+
+        return nodes.NODE_CLASS_MAPPINGS['AlignYourStepsScheduler']().get_sigmas(scheduler[4:], steps, denoise=1.0)[0]
+
+    return comfy.samplers.calculate_sigmas(model_sampling, scheduler, steps).cpu()
+
+
+def calculate_sigmas(model, sampler_name, scheduler, steps):
+    """
+    memoized sigma schedule, keyed by scheduler, steps and model sampling type.
+    (denoise is already converted to start_at_step by the callers)
+    a copy is returned since samplers may modify the sigmas in place.
+    """
+    model_sampling = model.get_model_object("model_sampling")
+    discard_penultimate_sigma = sampler_name in ['dpm_2', 'dpm_2_ancestral', 'uni_pc', 'uni_pc_bh2']
+
+    key = scheduler, discard_penultimate_sigma, steps, model_sampling_key(model_sampling)
+    sigmas = sigmas_cache.get(key)
+
+    if sigmas is None:
+        total_steps = steps + 1 if discard_penultimate_sigma else steps
+
+        sigmas = _calculate_sigmas(model_sampling, scheduler, total_steps)
+
+        if discard_penultimate_sigma and len(sigmas) > 1:
+            sigmas = torch.cat([sigmas[:-2], sigmas[-1:]])
+
+        sigmas_cache[key] = sigmas
+
+    return sigmas.clone()
+
+
+def get_scheduler_func(scheduler):
+    def scheduler_func(model, sampler_name, steps):
+        return calculate_sigmas(model, sampler_name, scheduler, steps)
+
+    return scheduler_func
+
+
 def impact_sampling(*args, **kwargs):
     if 'RegionalSampler' not in nodes.NODE_CLASS_MAPPINGS:
         utils.try_install_custom_node('https://github.com/ltdrdata/ComfyUI-Impact-Pack',
                                       "'Impact Pack' extension is required.")
         raise Exception(f"[ERROR] You need to install 'ComfyUI-Impact-Pack'")
 
-    return nodes.NODE_CLASS_MAPPINGS['RegionalSampler'].separated_sample(*args, **kwargs)
+    separated_sample = nodes.NODE_CLASS_MAPPINGS['RegionalSampler'].separated_sample
+
+    if 'scheduler_func' in kwargs and 'scheduler_func' not in inspect.signature(separated_sample).parameters:
+        if kwargs.get('scheduler') in custom_schedules:
+            raise Exception(f"[ERROR] Custom sigma schedules require the latest 'ComfyUI-Impact-Pack'. Please update it.")
+
+        # outdated Impact Pack: it calculates the sigmas by itself
+        del kwargs['scheduler_func']
+
+    return separated_sample(*args, **kwargs)
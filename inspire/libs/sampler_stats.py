@@ -0,0 +1,124 @@
+import bisect
+import threading
+import time
+from collections import deque
+
+import torch
+
+
+def synchronize(device):
+    # NOTE: CUDA kernels are asynchronous, so the phase boundaries are synchronized to attribute the GPU time correctly.
+    #       steps are not synchronized (that would stall the kernel queue), the time between step callbacks is measured instead.
+    if isinstance(device, torch.device) and device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+class SamplingTimer:
+    """
+    measures the phases of a single sampling job:
+        noise -> model_load -> step * (N-1) -> finalize
+
+    the sampler loads/patches the model by itself, so 'model_load' is the time until the first step callback (it includes the first step).
+    """
+    def __init__(self, device):
+        self.device = device
+        self.start = self.last = time.perf_counter()
+        self.phases = {}
+        self.steps = 0
+        self.step_ms = []
+
+    def lap(self, phase):
+        synchronize(self.device)
+        now = time.perf_counter()
+        self.phases[phase] = (now - self.last) * 1000
+        self.last = now
+
+    def wrap_callback(self, callback=None):
+        def timed_callback(step, x0, x, total_steps):
+            now = time.perf_counter()
+            if self.steps == 0:
+                self.phases['model_load'] = (now - self.last) * 1000
+            else:
+                self.step_ms.append((now - self.last) * 1000)
+            self.steps += 1
+            self.last = now
+
+            if callback is not None:
+                callback(step, x0, x, total_steps)
+
+        return timed_callback
+
+    def record(self, **info):
+        total_ms = (self.last - self.start) * 1000
+        steps_ms = sum(self.step_ms)
+
+        record = dict(info)
+        record.update({f"{phase}_ms": round(ms, 3) for phase, ms in self.phases.items()})
+        record['steps'] = self.steps
+        record['step_ms'] = [round(ms, 3) for ms in self.step_ms]
+        record['total_ms'] = round(total_ms, 3)
+        record['it_per_sec'] = round(len(self.step_ms) / (steps_ms / 1000), 3) if steps_ms > 0 else None
+        return record
+
+
+class SamplerStats:
+    """
+    aggregated timings of the `inspire_ksampler` jobs (served on `/inspire/stats/sampler`)
+    """
+    PHASES = ['noise', 'model_load', 'step', 'finalize', 'total']
+    BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 60000]
+
+    def __init__(self, max_records=100):
+        self.lock = threading.Lock()
+        self.max_records = max_records
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.jobs = 0
+            self.records = deque(maxlen=self.max_records)
+            # the last bucket counts everything above the last bound
+            self.histograms = {phase: [0] * (len(self.BUCKETS_MS) + 1) for phase in self.PHASES}
+            self.sums = {phase: 0.0 for phase in self.PHASES}
+
+    def add_sample(self, phase, ms):
+        self.histograms[phase][bisect.bisect_left(self.BUCKETS_MS, ms)] += 1
+        self.sums[phase] += ms
+
+    def add(self, record):
+        with self.lock:
+            self.jobs += 1
+            self.records.append(record)
+
+            for phase in self.PHASES:
+                if phase == 'step':
+                    for ms in record['step_ms']:
+                        self.add_sample(phase, ms)
+                elif f"{phase}_ms" in record:
+                    self.add_sample(phase, record[f"{phase}_ms"])
+
+    def get_data(self):
+        with self.lock:
+            histograms = {}
+            for phase in self.PHASES:
+                count = sum(self.histograms[phase])
+                histograms[phase] = {
+                    'count': count,
+                    'mean_ms': round(self.sums[phase] / count, 3) if count > 0 else None,
+                    'counts': list(self.histograms[phase]),
+                }
+
+            return {'jobs': self.jobs, 'bounds_ms': self.BUCKETS_MS, 'histograms': histograms, 'recent': list(self.records)}
+
+
+stats = SamplerStats()
+
+
+def report(record):
+    stats.add(record)
+
+    try:
+        from server import PromptServer
+        PromptServer.instance.send_sync("inspire-sampler-stats", record)
+    except Exception:
+        pass
@@ -0,0 +1,216 @@
+import hashlib
+import os
+import threading
+import weakref
+
+import torch
+import comfy.model_management
+import comfy.utils
+import folder_paths
+
+MAX_CACHE_SIZE = 4 * 1024 ** 3  # bytes
+SAMPLED_ELEMENTS = 4096  # per weight tensor
+
+if hasattr(folder_paths, 'get_user_directory'):
+    cache_dir = os.path.join(folder_paths.get_user_directory(), 'inspire', 'sampling_cache')
+else:
+    cache_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'sampling_cache')
+
+
+class Uncacheable(Exception):
+    pass
+
+
+def update_tensor_hash(h, tensor, sampled=False):
+    h.update(f"T{tuple(tensor.shape)}{tensor.dtype}".encode())
+
+    if tensor.device.type == 'meta':
+        return
+
+    tensor = tensor.detach().reshape(-1)
+    if sampled and tensor.numel() > SAMPLED_ELEMENTS:
+        # model weights are fingerprinted by a strided sample, hashing the whole weights is too slow
+        tensor = tensor[::tensor.numel() // SAMPLED_ELEMENTS]
+
+    h.update(memoryview(tensor.cpu().contiguous().view(torch.uint8).numpy()))
+
+
+def update_hash(h, value, sampled=False, path=None):
+    """
+    hash of the nested conditioning/latent/option values.
+    raises `Uncacheable` for the values that can't be identified by their content (e.g. ControlNet objects, self-referencing values).
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        h.update(f"{type(value).__name__}:{value!r};".encode())
+        return
+    elif isinstance(value, torch.Tensor):
+        update_tensor_hash(h, value, sampled)
+        return
+
+    # containers and closures on the current path (a cycle can't be hashed by content)
+    path = path or set()
+    if id(value) in path:
+        raise Uncacheable(f"self-referencing {type(value).__name__}")
+    path = path | {id(value)}
+
+    if isinstance(value, dict):
+        h.update(b"{")
+        for k in sorted(value.keys(), key=str):
+            update_hash(h, k)
+            update_hash(h, value[k], sampled, path)
+        h.update(b"}")
+    elif isinstance(value, (list, tuple)):
+        h.update(b"[")
+        for x in value:
+            update_hash(h, x, sampled, path)
+        h.update(b"]")
+    elif callable(value) and hasattr(value, '__code__') and not hasattr(value, '__self__'):
+        # patch functions are identified by their code and captured values
+        h.update(f"F{value.__module__}.{value.__qualname__};".encode())
+        for cell in value.__closure__ or []:
+            try:
+                contents = cell.cell_contents
+            except ValueError:
+                raise Uncacheable(f"empty closure cell of {value.__qualname__}")
+            update_hash(h, contents, sampled, path)
+    else:
+        raise Uncacheable(f"{type(value).__name__}")
+
+
+weight_fingerprints = weakref.WeakKeyDictionary()
+
+
+def weight_backups(model):
+    """
+    original weights of the keys that are patched in place (e.g. LoRA) by the patchers sharing the diffusion model of `model`
+    """
+    patchers = [model]
+    for loaded_model in getattr(comfy.model_management, 'current_loaded_models', []):
+        patcher = getattr(loaded_model, 'model', None)
+        if patcher is not None and patcher is not model and getattr(patcher, 'model', None) is model.model:
+            patchers.append(patcher)
+
+    backups = {}
+    for patcher in patchers:
+        for k, v in getattr(patcher, 'backup', {}).items():
+            backups[k] = getattr(v, 'weight', v)  # newer ComfyUI keeps (weight, inplace_update)
+
+    return backups
+
+
+def model_fingerprint(model):
+    diffusion_model = model.model
+    fingerprint = weight_fingerprints.get(diffusion_model)
+
+    if fingerprint is None:
+        # NOTE: the loaded patcher writes its patches into the module weights in place,
+        #       so the unpatched weights are fingerprinted (the patches are hashed below separately)
+        backups = weight_backups(model)
+
+        h = hashlib.sha256()
+        h.update(type(diffusion_model).__name__.encode())
+        for k, v in diffusion_model.state_dict().items():
+            h.update(k.encode())
+            update_tensor_hash(h, backups.get(k, v), sampled=True)
+        fingerprint = h.hexdigest()
+        weight_fingerprints[diffusion_model] = fingerprint
+
+    h = hashlib.sha256(fingerprint.encode())
+    update_hash(h, model.patches, sampled=True)
+    update_hash(h, model.model_options)
+    update_hash(h, getattr(model, 'object_patches', {}))
+    return h.hexdigest()
+
+
+def make_key(model, positive, negative, latent, **options):
+    """
+    content address of a sampling job, or None if some of the inputs can't be identified.
+    """
+    try:
+        h = hashlib.sha256()
+        h.update(model_fingerprint(model).encode())
+        update_hash(h, positive)
+        update_hash(h, negative)
+        update_hash(h, latent)
+        update_hash(h, options)
+        return h.hexdigest()
+    except Uncacheable as e:
+        print(f"[Inspire Pack] WARN: sampling result cache is ignored (unidentifiable input: {e})")
+        return None
+    except RecursionError:
+        print(f"[Inspire Pack] WARN: sampling result cache is ignored (too deeply nested input)")
+        return None
+
+
+class SamplingResultCache:
+    """
+    on-disk LRU cache of the sampled latents (the mtime of a file is its last use)
+    """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+    def file_path(self, key):
+        return os.path.join(self.path, f"{key}.safetensors")
+
+    def get(self, key):
+        path = self.file_path(key)
+
+        with self.lock:
+            if not os.path.exists(path):
+                return None
+
+            try:
+                os.utime(path)
+                return comfy.utils.load_torch_file(path)['samples']
+            except Exception:
+                print(f"[Inspire Pack] WARN: broken sampling result cache is removed: {path}")
+                os.remove(path)
+                return None
+
+    def put(self, key, samples):
+        path = self.file_path(key)
+
+        with self.lock:
+            temp_path = f"{path}.tmp"
+
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                comfy.utils.save_torch_file({'samples': samples.contiguous()}, temp_path)
+                os.replace(temp_path, path)
+
+                self.evict()
+            except Exception as e:
+                # NOTE: failing to cache must not throw away the sampled result
+                print(f"[Inspire Pack] WARN: failed to store the sampling result cache: {e}")
+                if os.path.exists(temp_path):
+                    try:
+                        os.remove(temp_path)
+                    except OSError:
+                        pass
+
+    def evict(self):
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith('.safetensors'):
+                stat = os.stat(os.path.join(self.path, name))
+                files.append((stat.st_mtime, stat.st_size, name))
+
+        total_size = sum(x[1] for x in files)
+        for _, size, name in sorted(files):
+            if total_size <= self.max_size:
+                break
+
+            os.remove(os.path.join(self.path, name))
+            total_size -= size
+
+    def clear(self):
+        with self.lock:
+            if os.path.exists(self.path):
+                for name in os.listdir(self.path):
+                    if name.endswith('.safetensors'):
+                        os.remove(os.path.join(self.path, name))
+
+
+cache = SamplingResultCache(cache_dir, MAX_CACHE_SIZE)
@@ -1,4 +1,6 @@
 import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 import numpy as np
 import torch
@@ -6,20 +8,29 @@ from PIL import Image, ImageDraw
 import math
 
 
+def get_noise_generator(seed, noise_device):
+    """
+    CPU noise is drawn from a private generator per call, so it doesn't depend on (or disturb) the global seed,
+    which other threads may reseed concurrently. The sequence is identical to `torch.manual_seed(seed)`.
+    GPU noise keeps the A1111 behavior: the global CUDA generator is seeded.
+    """
+    if noise_device == "cpu":
+        return torch.Generator(device="cpu").manual_seed(seed)
+    else:
+        torch.cuda.manual_seed(seed)
+        return None
+
+
 def apply_variation_noise(latent_image, noise_device, variation_seed, variation_strength, mask=None):
     latent_size = latent_image.size()
     latent_size_1batch = [1, latent_size[1], latent_size[2], latent_size[3]]
 
-    if noise_device == "cpu":
-        variation_generator = torch.manual_seed(variation_seed)
-    else:
-        torch.cuda.manual_seed(variation_seed)
-        variation_generator = None
+    variation_generator = get_noise_generator(variation_seed, noise_device)
 
     variation_latent = torch.randn(latent_size_1batch, dtype=latent_image.dtype, layout=latent_image.layout,
                                    generator=variation_generator, device=noise_device)
 
-    variation_noise = variation_latent.expand(latent_image.size()[0], -1, -1, -1)
+    variation_noise = variation_latent.to(latent_image.device).expand(latent_image.size()[0], -1, -1, -1)
 
     if variation_strength == 0:
         return latent_image
@@ -34,40 +45,105 @@ def apply_variation_noise(latent_image, noise_device, variation_seed, variation_
 
 # CREDIT: https://github.com/BlenderNeko/ComfyUI_Noise/blob/afb14757216257b12268c91845eac248727a55e2/nodes.py#L68
 #         https://discuss.pytorch.org/t/help-regarding-slerp-function-for-generative-model-sampling/32475/3
-def slerp(val, low, high):
-    dims = low.shape
+def slerp(val, low, high, out=None, eps=1e-6):
+    """
+    spherical interpolation between low and high.
+    val can be a scalar or a 1-D tensor of strengths. In the latter case, a whole strength sweep is produced in one call,
+    broadcasting a single batch of low/high over the strengths.
+    falls back to lerp when low and high are (nearly) parallel, and writes into `out` if it is given.
+    """
+    val = torch.as_tensor(val, dtype=low.dtype, device=low.device).reshape(-1)
+    batch_cnt = max(low.shape[0], high.shape[0], val.shape[0])
+    dims = (batch_cnt, ) + tuple(low.shape[1:])
 
-    low = low.reshape(dims[0], -1)
-    high = high.reshape(dims[0], -1)
+    low = low.reshape(low.shape[0], -1)
+    high = high.reshape(high.shape[0], -1)
 
-    low_norm = low/torch.norm(low, dim=1, keepdim=True)
-    high_norm = high/torch.norm(high, dim=1, keepdim=True)
+    # NOTE: zero vectors are handled by clamping the norm product, instead of scrubbing NaN after normalization
+    norm = torch.linalg.vector_norm(low, dim=1) * torch.linalg.vector_norm(high, dim=1)
+    dot = (low * high).sum(1) / norm.clamp_min(eps)
+    omega = torch.acos(dot.clamp(-1.0, 1.0))
+    so = torch.sin(omega)
 
-    low_norm[low_norm != low_norm] = 0.0
-    high_norm[high_norm != high_norm] = 0.0
+    parallel = so < eps
+    so = torch.where(parallel, torch.ones_like(so), so)
+    low_scale = torch.where(parallel, 1.0 - val, torch.sin((1.0 - val) * omega) / so)
+    high_scale = torch.where(parallel, val, torch.sin(val * omega) / so)
 
-    omega = torch.acos((low_norm*high_norm).sum(1))
-    so = torch.sin(omega)
-    res = (torch.sin((1.0-val)*omega)/so).unsqueeze(1)*low + (torch.sin(val*omega)/so).unsqueeze(1) * high
+    if out is None:
+        out = torch.empty(dims, dtype=low.dtype, device=low.device)
 
-    return res.reshape(dims)
+    res = out.view(batch_cnt, -1)
+
+    torch.mul(low, low_scale.unsqueeze(1), out=res)
+    res.addcmul_(high, high_scale.unsqueeze(1))
+
+    return out
 
 
 def mix_noise(from_noise, to_noise, strength, variation_method):
+    """
+    strength can be a scalar or a 1-D tensor of strengths (one per batch item).
+    """
     if variation_method == 'slerp':
         mixed_noise = slerp(strength, from_noise, to_noise)
     else:
         # linear
+        if isinstance(strength, torch.Tensor):
+            strength = strength.reshape((-1, ) + (1, ) * (from_noise.dim() - 1))
+            scale_factor = torch.sqrt((1 - strength) ** 2 + strength ** 2)
+        else:
+            scale_factor = math.sqrt((1 - strength) ** 2 + strength ** 2)
+
         mixed_noise = (1 - strength) * from_noise + strength * to_noise
 
         # NOTE: Since the variance of the Gaussian noise in mixed_noise has changed, it must be corrected through scaling.
-        scale_factor = math.sqrt((1 - strength) ** 2 + strength ** 2)
         mixed_noise /= scale_factor
 
     return mixed_noise
 
 
-def prepare_noise(latent_image, seed, noise_inds=None, noise_device="cpu", incremental_seed_mode="comfy", variation_seed=None, variation_strength=None, variation_method="linear"):
+def parse_variation_sweep(variation_sweep, batch_cnt):
+    """
+    parses the strengths of 'variation sweep' mode.
+        - "0.1, 0.3, 0.5": explicit list. If it is shorter than batch size, the last strength is repeated.
+        - "0.0~1.0": linspace from start to stop over the batch.
+    """
+    variation_sweep = (variation_sweep or "").strip()
+
+    try:
+        if '~' in variation_sweep:
+            start, stop = variation_sweep.split('~')
+            return torch.linspace(float(start), float(stop), batch_cnt).tolist()
+
+        strengths = [float(x) for x in variation_sweep.split(',') if x.strip() != '']
+    except Exception:
+        raise Exception(f"[ERROR] Invalid variation_sweep value '{variation_sweep}'. e.g. '0.1, 0.2, 0.3' or '0.0~1.0'")
+
+    if len(strengths) == 0:
+        raise Exception(f"[ERROR] 'variation sweep' mode requires `variation_sweep` strengths. e.g. '0.1, 0.2, 0.3' or '0.0~1.0'")
+
+    strengths = strengths[:batch_cnt]
+    return strengths + [strengths[-1]] * (batch_cnt - len(strengths))
+
+
+def with_caller_inference_mode(func):
+    """
+    wraps func to run in the inference mode of the calling thread.
+    inference mode is thread-local, so without this, a worker thread can't update the inference tensors
+    allocated by a node (ComfyUI executes nodes in `torch.inference_mode()`).
+    """
+    enabled = torch.is_inference_mode_enabled()
+
+    def wrapper(*args, **kwargs):
+        with torch.inference_mode(enabled):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def prepare_noise(latent_image, seed, noise_inds=None, noise_device="cpu", incremental_seed_mode="comfy", variation_seed=None, variation_strength=None, variation_method="linear",
+                  variation_sweep=None):
     """
     creates random noise given a latent image and a seed.
     optional arg skip can be used to skip and discard x number of noise generations for a given seed
@@ -76,12 +152,10 @@ def prepare_noise(latent_image, seed, noise_inds=None, noise_device="cpu", incre
     latent_size = latent_image.size()
     latent_size_1batch = [1, latent_size[1], latent_size[2], latent_size[3]]
 
-    if variation_strength is not None and variation_strength > 0 or incremental_seed_mode.startswith("variation str inc"):
-        if noise_device == "cpu":
-            variation_generator = torch.manual_seed(variation_seed)
-        else:
-            torch.cuda.manual_seed(variation_seed)
-            variation_generator = None
+    is_variation_sweep = incremental_seed_mode.startswith("variation str inc") or incremental_seed_mode == "variation sweep"
+
+    if variation_strength is not None and variation_strength > 0 or is_variation_sweep:
+        variation_generator = get_noise_generator(variation_seed, noise_device)
 
         variation_latent = torch.randn(latent_size_1batch, dtype=latent_image.dtype, layout=latent_image.layout,
                                        generator=variation_generator, device=noise_device)
@@ -97,9 +171,8 @@ def prepare_noise(latent_image, seed, noise_inds=None, noise_device="cpu", incre
             if strength_up is not None:
                 strength += strength_up
 
-            variation_noise = variation_latent.expand(input_latent.size()[0], -1, -1, -1)
-
-            mixed_noise = mix_noise(input_latent, variation_noise, strength, variation_method)
+            # NOTE: variation_latent is a single batch, which is broadcast over input_latent
+            mixed_noise = mix_noise(input_latent, variation_latent, strength, variation_method)
 
             return mixed_noise
 
@@ -107,57 +180,44 @@ def prepare_noise(latent_image, seed, noise_inds=None, noise_device="cpu", incre
     if noise_inds is None and incremental_seed_mode == "incremental":
         batch_cnt = latent_size[0]
 
-        latents = None
-        for i in range(batch_cnt):
-            if noise_device == "cpu":
-                generator = torch.manual_seed(seed+i)
-            else:
-                torch.cuda.manual_seed(seed+i)
-                generator = None
-
-            latent = torch.randn(latent_size_1batch, dtype=latent_image.dtype, layout=latent_image.layout,
-                                 generator=generator, device=noise_device)
+        latents = torch.empty(latent_size, dtype=latent_image.dtype, layout=latent_image.layout, device=noise_device)
 
-            latent = apply_variation(latent)
+        def generate(i):
+            generator = get_noise_generator(seed+i, noise_device)
+            torch.randn(latent_size_1batch, generator=generator, out=latents[i:i+1])
 
-            if latents is None:
-                latents = latent
-            else:
-                latents = torch.cat((latents, latent), dim=0)
+        if noise_device == "cpu" and batch_cnt > 1:
+            # each sample index owns its generator, so the result doesn't depend on the thread count
+            with ThreadPoolExecutor(max_workers=min(batch_cnt, os.cpu_count() or 1)) as executor:
+                list(executor.map(with_caller_inference_mode(generate), range(batch_cnt)))
+        else:
+            # the global CUDA generator can't be shared across threads
+            for i in range(batch_cnt):
+                generate(i)
 
-        return latents
+        return apply_variation(latents)
 
-    # method: incremental variation batch noise
-    elif noise_inds is None and incremental_seed_mode.startswith("variation str inc"):
+    # method: variation sweep batch noise ('variation str inc' is a linear sweep)
+    #         the base noise and the variation noise are generated only once and mixed with a strength vector
+    elif noise_inds is None and is_variation_sweep:
         batch_cnt = latent_size[0]
 
-        latents = None
-        for i in range(batch_cnt):
-            if noise_device == "cpu":
-                generator = torch.manual_seed(seed)
-            else:
-                torch.cuda.manual_seed(seed)
-                generator = None
-
-            latent = torch.randn(latent_size_1batch, dtype=latent_image.dtype, layout=latent_image.layout,
-                                 generator=generator, device=noise_device)
-
+        if incremental_seed_mode == "variation sweep":
+            strengths = parse_variation_sweep(variation_sweep, batch_cnt)
+        else:
             step = float(incremental_seed_mode[18:])
-            latent = apply_variation(latent, step*i)
+            strengths = [(variation_strength or 0.0) + step*i for i in range(batch_cnt)]
 
-            if latents is None:
-                latents = latent
-            else:
-                latents = torch.cat((latents, latent), dim=0)
+        generator = get_noise_generator(seed, noise_device)
 
-        return latents
+        latent = torch.randn(latent_size_1batch, dtype=latent_image.dtype, layout=latent_image.layout,
+                             generator=generator, device=noise_device)
+
+        strengths = torch.tensor(strengths, dtype=latent.dtype, device=latent.device)
+        return mix_noise(latent, variation_latent, strengths, variation_method)
 
     # method: comfy batch noise
-    if noise_device == "cpu":
-        generator = torch.manual_seed(seed)
-    else:
-        torch.cuda.manual_seed(seed)
-        generator = None
+    generator = get_noise_generator(seed, noise_device)
 
     if noise_inds is None:
         latents = torch.randn(latent_image.size(), dtype=latent_image.dtype, layout=latent_image.layout,
@@ -177,6 +237,14 @@ def prepare_noise(latent_image, seed, noise_inds=None, noise_device="cpu", incre
     return noises
 
 
+def pack_rgb(image):
+    """
+    [..., 3] RGB image (0.0 ~ 1.0) -> [...] 24-bit int colors (0xRRGGBB)
+    """
+    temp = (torch.clamp(image, 0, 1.0) * 255.0).round().to(torch.int)
+    return torch.bitwise_left_shift(temp[..., 0], 16) + torch.bitwise_left_shift(temp[..., 1], 8) + temp[..., 2]
+
+
 def pil2tensor(image):
     return torch.from_numpy(np.array(image).astype(np.float32) / 255.0).unsqueeze(0)
 
@@ -15,6 +15,7 @@ import random
 
 from server import PromptServer
 from .libs import utils, common
+from . import a1111_compat
 from .backend_support import CheckpointLoaderSimpleShared
 
 prompt_builder_preset = {}
@@ -558,8 +559,8 @@ class SeedExplorer:
     CATEGORY = "InspirePack/Prompt"
 
     @staticmethod
-    def apply_variation(start_noise, seed_items, noise_device, mask=None):
-        noise = start_noise
+    def parse_variation_items(seed_items):
+        variations = []
         for x in seed_items:
             if isinstance(x, str):
                 item = x.split(':')
@@ -568,14 +569,16 @@ class SeedExplorer:
 
             if len(item) == 2:
                 try:
-                    variation_seed = int(item[0])
-                    variation_strength = float(item[1])
-
-                    noise = utils.apply_variation_noise(noise, noise_device, variation_seed, variation_strength, mask=mask)
+                    variations.append((int(item[0]), float(item[1])))
                 except Exception:
                     print(f"[ERROR] IGNORED: SeedExplorer failed to processing '{x}'")
                     traceback.print_exc()
-        return noise
+        return variations
+
+    @staticmethod
+    def apply_variation(start_noise, seed_items, noise_device, mask=None):
+        noise = a1111_compat.Inspire_LazyNoise.from_noise(start_noise)
+        return noise.with_variations(SeedExplorer.parse_variation_items(seed_items), noise_device, mask)
 
     def doit(self, latent, seed_prompt, enable_additional, additional_seed, additional_strength, noise_mode,
              initial_batch_seed_mode):
@@ -601,10 +604,8 @@ class SeedExplorer:
             else:
                 hd_seed = int(hd)
 
-            noise = utils.prepare_noise(latent_image, hd_seed, None, noise_device, initial_batch_seed_mode)
-            noise = noise.to(device)
+            noise = a1111_compat.Inspire_LazyNoise(latent_image, hd_seed, noise_device, initial_batch_seed_mode)
             noise = SeedExplorer.apply_variation(noise, tl, noise_device)
-            noise = noise.cpu()
 
             return (noise,)
 
@@ -4,6 +4,7 @@ import comfy
 import nodes
 import torch
 from . import prompt_support
+from . import a1111_compat
 from .libs import utils, common
 
 
@@ -75,8 +76,7 @@ def color_to_mask(color_mask, mask_color):
     except Exception:
         raise Exception(f"[ERROR] Invalid mask_color value. mask_color should be a color value for RGB")
 
-    temp = (torch.clamp(color_mask, 0, 1.0) * 255.0).round().to(torch.int)
-    temp = torch.bitwise_left_shift(temp[:, :, :, 0], 16) + torch.bitwise_left_shift(temp[:, :, :, 1], 8) + temp[:, :, :, 2]
+    temp = utils.pack_rgb(color_mask)
     mask = torch.where(temp == selected, 1.0, 0.0)
     return mask
 
@@ -424,8 +424,8 @@ class RegionalSeedExplorerMask:
         device = comfy.model_management.get_torch_device()
         noise_device = "cpu" if noise_mode == "CPU" else device
 
-        noise = noise.to(device)
-        mask = mask.to(device)
+        # NOTE: noise stays lazy here and is materialized once on the sampling device
+        noise = a1111_compat.Inspire_LazyNoise.from_noise(noise)
 
         if len(mask.shape) == 2:
             mask = mask.unsqueeze(0)
@@ -444,11 +444,9 @@ class RegionalSeedExplorerMask:
 
             noise = prompt_support.SeedExplorer.apply_variation(noise, items, noise_device, mask)
         except Exception:
-            print(f"[ERROR] IGNORED: RegionalSeedExplorerColorMask is failed.")
+            print(f"[ERROR] IGNORED: RegionalSeedExplorerMask is failed.")
             traceback.print_exc()
 
-        noise = noise.cpu()
-        mask.cpu()
         return (noise,)
 
 
@@ -478,15 +476,13 @@ class RegionalSeedExplorerColorMask:
         device = comfy.model_management.get_torch_device()
         noise_device = "cpu" if noise_mode == "CPU" else device
 
-        color_mask = color_mask.to(device)
-        noise = noise.to(device)
+        # NOTE: noise stays lazy here and is materialized once on the sampling device
+        noise = a1111_compat.Inspire_LazyNoise.from_noise(noise)
 
         mask = color_to_mask(color_mask, mask_color)
         original_mask = mask
         mask = torch.nn.functional.interpolate(mask.reshape((-1, 1, mask.shape[-2], mask.shape[-1])), size=(noise.shape[2], noise.shape[3]), mode="bilinear").squeeze(0)
 
-        mask = mask.to(device)
-
         try:
             seed_prompt = seed_prompt.replace("\n", "")
             items = seed_prompt.strip().split(",")
@@ -502,9 +498,6 @@ class RegionalSeedExplorerColorMask:
             print(f"[ERROR] IGNORED: RegionalSeedExplorerColorMask is failed.")
             traceback.print_exc()
 
-        color_mask.cpu()
-        noise = noise.cpu()
-        original_mask = original_mask.cpu()
         return (noise, original_mask)
 
 
@@ -1,3 +1,7 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 from . import a1111_compat
 import comfy
@@ -5,6 +9,352 @@ from .libs import common, utils
 from comfy import model_management
 from comfy_extras import nodes_custom_sampler
 import nodes
+import folder_paths
+
+
+class ProgressCapture:
+    """
+    progress callback that captures the latent of every `interval` steps (and the last step)
+    into an output buffer preallocated on the first callback.
+    max_frames > 0 keeps only the latest `max_frames` frames (ring buffer).
+    if save_prefix is given, each captured latent is also saved to the output directory as it's produced.
+    if preview_mode is not 'none', each captured latent is also decoded to a fast preview image in a worker thread.
+
+    GPU -> CPU copies are issued non-blocking on a side stream into pinned memory,
+    so the sampling loop is not stalled. They are synchronized only when the result is read.
+    """
+    def __init__(self, model, interval, max_frames=0, save_prefix="", preview_mode="none"):
+        self.model = model
+        self.interval = interval
+        self.max_frames = max_frames
+        self.save_prefix = save_prefix
+        self.preview_mode = preview_mode
+        self.buffer = None
+        self.capacity = 0
+        self.batch = 0
+        self.count = 0
+        self.stream = None
+        self.executor = None
+        self.futures = []
+        self.save_path = None
+        self.previews = deque(maxlen=max_frames if max_frames > 0 else None)
+        self.taesd = None
+
+        if preview_mode == 'taesd':
+            self.taesd = load_taesd(model.model.latent_format)
+            if self.taesd is None:
+                print(f"[Inspire Pack] WARN: TAESD decoder for this model is not found in 'models/vae_approx'. 'latent2rgb' preview will be used instead.")
+
+    @staticmethod
+    def frame_count(total_steps, interval):
+        # multiples of interval + the last step
+        return (total_steps - 1) // interval + 1 + (1 if (total_steps - 1) % interval != 0 else 0)
+
+    def empty(self, shape, x):
+        device = model_management.intermediate_device()
+        pin_memory = self.stream is not None and torch.device(device).type == 'cpu'
+        return torch.empty(shape, dtype=x.dtype, device=device, pin_memory=pin_memory)
+
+    def allocate(self, x, total_steps):
+        self.capacity = ProgressCapture.frame_count(total_steps, self.interval)
+        if self.max_frames > 0:
+            self.capacity = min(self.capacity, self.max_frames)
+
+        if x.device.type == 'cuda' and torch.device(model_management.intermediate_device()) != x.device:
+            self.stream = torch.cuda.Stream(device=x.device)
+
+        self.batch = x.shape[0]
+        self.buffer = self.empty((self.capacity * self.batch, ) + tuple(x.shape[1:]), x)
+
+    def grow(self, x):
+        # unexpected extra frame: grow instead of overwriting
+        self.synchronize()
+        buffer = self.empty((self.buffer.shape[0] + self.batch, ) + tuple(self.buffer.shape[1:]), x)
+        buffer[:self.buffer.shape[0]].copy_(self.buffer)
+        self.buffer = buffer
+        self.capacity += 1
+
+    def copy_to_host(self, dst, x):
+        if self.stream is None:
+            dst.copy_(x)
+            return None
+
+        self.stream.wait_stream(torch.cuda.current_stream(x.device))
+        with torch.cuda.stream(self.stream):
+            dst.copy_(x, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+
+        # x must not be reused by the allocator until the copy is done
+        x.record_stream(self.stream)
+        return event
+
+    def decode_preview(self, x):
+        x = self.model.model.process_latent_in(x)
+
+        if self.taesd is not None and x.dim() == 4:
+            device = model_management.get_torch_device()
+            with torch.no_grad():
+                image = self.taesd.to(device).decode(x.to(device=device, dtype=torch.float32))
+            return ((image + 1.0) / 2.0).clamp(0, 1).movedim(1, -1).cpu()
+
+        latent_format = self.model.model.latent_format
+        if latent_format.latent_rgb_factors is None:
+            return None
+
+        factors = torch.tensor(latent_format.latent_rgb_factors, dtype=torch.float32, device=x.device)
+        image = x.float().movedim(1, -1) @ factors
+
+        bias = getattr(latent_format, 'latent_rgb_factors_bias', None)
+        if bias is not None:
+            image += torch.tensor(bias, dtype=torch.float32, device=x.device)
+
+        # video latent: (b, t, h, w, 3) -> (b*t, h, w, 3)
+        image = image.reshape((-1, ) + tuple(image.shape[-3:]))
+        return ((image + 1.0) / 2.0).clamp(0, 1).cpu()
+
+    def submit_frame(self, x, index):
+        if self.executor is None:
+            if self.save_prefix:
+                full_output_folder, filename, counter, _, _ = folder_paths.get_save_image_path(self.save_prefix, folder_paths.get_output_directory())
+                self.save_path = full_output_folder, filename, counter
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+        # NOTE: a separate host copy is used, since a ring buffer slot can be overwritten before it's processed
+        host_x = self.empty(x.shape, x)
+        event = self.copy_to_host(host_x, x)
+
+        def process_frame():
+            if event is not None:
+                event.synchronize()
+
+            if self.save_prefix:
+                full_output_folder, filename, counter = self.save_path
+                file = os.path.join(full_output_folder, f"{filename}_{counter+index:05}_.latent")
+                output = {"latent_tensor": host_x.contiguous(), "latent_format_version_0": torch.tensor([])}
+                comfy.utils.save_torch_file(output, file)
+
+            if self.preview_mode != 'none':
+                try:
+                    preview = self.decode_preview(host_x)
+                except Exception as e:
+                    raise Exception(f"[ERROR] KSampler Progress: failed to decode the '{self.preview_mode}' preview of frame {index}: {e}") from e
+
+                if preview is not None:
+                    self.previews.append(preview)
+
+        self.futures.append(self.executor.submit(process_frame))
+
+    def __call__(self, step, x0, x, total_steps):
+        if (total_steps-1) != step and step % self.interval != 0:
+            return
+
+        x = self.model.model.process_latent_out(x)
+
+        if self.buffer is None:
+            self.allocate(x, total_steps)
+        elif self.count >= self.capacity and self.max_frames == 0:
+            self.grow(x)
+
+        slot = self.count % self.capacity
+        self.copy_to_host(self.buffer[slot*self.batch:(slot+1)*self.batch], x)
+
+        if self.save_prefix or self.preview_mode != 'none':
+            self.submit_frame(x, self.count)
+
+        self.count += 1
+
+    def synchronize(self):
+        if self.stream is not None:
+            self.stream.synchronize()
+
+    def result(self):
+        self.synchronize()
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+            try:
+                # NOTE: re-raise the failure of a worker (e.g. failed to save a latent file) instead of silently losing frames
+                futures, self.futures = self.futures, []
+                for future in futures:
+                    future.result()
+            finally:
+                # NOTE: the cached TAESD decoder is outside of ComfyUI's model management, so don't leave it on the GPU
+                if self.taesd is not None:
+                    self.taesd.to('cpu')
+
+        if self.count == 0:
+            return None
+
+        if self.count <= self.capacity:
+            return self.buffer[:self.count*self.batch]
+
+        # ring buffer is full: the oldest frame is at the next slot
+        slot = self.count % self.capacity
+        return torch.cat((self.buffer[slot*self.batch:], self.buffer[:slot*self.batch]))
+
+    def preview(self):
+        # NOTE: call after result()
+        if len(self.previews) == 0:
+            return utils.empty_pil_tensor()
+
+        return torch.cat(list(self.previews))
+
+
+class ProgressLatent(dict):
+    """
+    LATENT that keeps progress frames as a list of chunks.
+    'samples' is concatenated only when a consumer accesses it, so chained progress nodes don't copy the whole history per stage.
+    lazy=False materializes 'samples' immediately (the output is consumed by other nodes than the progress nodes).
+    """
+    def __init__(self, chunks, lazy=True):
+        super().__init__()
+        self.chunks = chunks
+        if not lazy:
+            self.materialize()
+
+    @staticmethod
+    def chunks_of(latent):
+        if isinstance(latent, ProgressLatent):
+            return list(latent.chunks)
+
+        return [latent['samples']]
+
+    def materialize(self):
+        if not dict.__contains__(self, 'samples') and len(self.chunks) > 0:
+            samples = self.chunks[0] if len(self.chunks) == 1 else torch.cat(self.chunks)
+            dict.__setitem__(self, 'samples', samples)
+            self.chunks = [samples]
+
+    def __missing__(self, key):
+        if key == 'samples' and len(self.chunks) > 0:
+            self.materialize()
+            return dict.__getitem__(self, key)
+
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'samples':
+            self.chunks = [value]
+        dict.__setitem__(self, key, value)
+
+    def __contains__(self, key):
+        return (key == 'samples' and len(self.chunks) > 0) or dict.__contains__(self, key)
+
+    def __iter__(self):
+        self.materialize()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self.materialize()
+        return dict.__len__(self)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        self.materialize()
+        return dict.keys(self)
+
+    def values(self):
+        self.materialize()
+        return dict.values(self)
+
+    def items(self):
+        self.materialize()
+        return dict.items(self)
+
+    def copy(self):
+        self.materialize()
+        return dict(self)
+
+    def pop(self, key, *args):
+        self.materialize()
+        value = dict.pop(self, key, *args)
+        if key == 'samples':
+            self.chunks = []
+        return value
+
+    def popitem(self):
+        self.materialize()
+        item = dict.popitem(self)
+        if item[0] == 'samples':
+            self.chunks = []
+        return item
+
+    def setdefault(self, key, default=None):
+        self.materialize()
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        self.materialize()
+        dict.update(self, *args, **kwargs)
+        self.chunks = [dict.__getitem__(self, 'samples')] if dict.__contains__(self, 'samples') else []
+
+    def __or__(self, other):
+        self.materialize()
+        return dict(self) | other
+
+    def __ror__(self, other):
+        self.materialize()
+        return other | dict(self)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __eq__(self, other):
+        self.materialize()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        self.materialize()
+        return dict.__ne__(self, other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        self.materialize()
+        return dict.__repr__(self)
+
+
+def is_chained_to_progress_only(prompt, unique_id, output_index):
+    """
+    True if the output is connected only to the `prev_progress_latent_opt` of the progress nodes.
+    """
+    if prompt is None or unique_id is None:
+        return False
+
+    consumers = 0
+    for node in prompt.values():
+        for name, value in node.get('inputs', {}).items():
+            if isinstance(value, list) and len(value) == 2 and str(value[0]) == str(unique_id) and value[1] == output_index:
+                if node.get('class_type') != "KSamplerAdvancedProgress //Inspire" or name != 'prev_progress_latent_opt':
+                    return False
+                consumers += 1
+
+    return consumers > 0
+
+
+taesd_decoders = {}
+
+
+def load_taesd(latent_format):
+    name = getattr(latent_format, 'taesd_decoder_name', None)
+    if name is None:
+        return None
+
+    if name not in taesd_decoders:
+        decoder_name = next((fn for fn in folder_paths.get_filename_list("vae_approx") if fn.startswith(name)), None)
+        if decoder_name is None:
+            return None
+
+        from comfy.taesd.taesd import TAESD
+        taesd_decoders[name] = TAESD(None, folder_paths.get_full_path("vae_approx", decoder_name), latent_channels=latent_format.latent_channels)
+
+    return taesd_decoders[name]
 
 
 class KSampler_progress(a1111_compat.KSampler_inspire):
@@ -16,7 +366,7 @@ class KSampler_progress(a1111_compat.KSampler_inspire):
                      "steps": ("INT", {"default": 20, "min": 1, "max": 10000}),
                      "cfg": ("FLOAT", {"default": 8.0, "min": 0.0, "max": 100.0}),
                      "sampler_name": (comfy.samplers.KSampler.SAMPLERS, ),
-                     "scheduler": (common.SCHEDULERS, ),
+                     "scheduler": (common.KSAMPLER_SCHEDULERS, ),
                      "positive": ("CONDITIONING", ),
                      "negative": ("CONDITIONING", ),
                      "latent_image": ("LATENT", ),
@@ -24,42 +374,34 @@ class KSampler_progress(a1111_compat.KSampler_inspire):
                      "noise_mode": (["GPU(=A1111)", "CPU"],),
                      "interval": ("INT", {"default": 1, "min": 1, "max": 10000}),
                      "omit_start_latent": ("BOOLEAN", {"default": True, "label_on": "True", "label_off": "False"}),
-                     }
+                     },
+                "optional": {
+                    "max_frames": ("INT", {"default": 0, "min": 0, "max": 10000}),
+                    "save_prefix": ("STRING", {"default": "", "placeholder": "If set, each captured latent is saved to the output directory as it's produced."}),
+                    "preview_mode": (["none", "latent2rgb", "taesd"],),
+                    }
                 }
 
     CATEGORY = "InspirePack/analysis"
 
-    RETURN_TYPES = ("LATENT", "LATENT")
-    RETURN_NAMES = ("latent", "progress_latent")
+    RETURN_TYPES = ("LATENT", "LATENT", "IMAGE")
+    RETURN_NAMES = ("latent", "progress_latent", "progress_preview")
 
     @staticmethod
-    def doit(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise, noise_mode, interval, omit_start_latent):
+    def doit(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise, noise_mode, interval, omit_start_latent, max_frames=0, save_prefix="", preview_mode="none"):
         adv_steps = int(steps / denoise)
 
-        if omit_start_latent:
-            result = []
-        else:
-            result = [latent_image['samples']]
-
-        result = []
-
-        def progress_callback(step, x0, x, total_steps):
-            if (total_steps-1) != step and step % interval != 0:
-                return
-
-            x = model.model.process_latent_out(x)
-            x = x.to(model_management.intermediate_device())
-            result.append(x)
+        progress_callback = ProgressCapture(model, interval, max_frames, save_prefix, preview_mode)
 
         latent_image, noise = a1111_compat.KSamplerAdvanced_inspire.sample(model, True, seed, adv_steps, cfg, sampler_name, scheduler, positive, negative, latent_image, (adv_steps-steps), adv_steps, noise_mode, False, callback=progress_callback)
 
-        if len(result) > 0:
-            result = torch.cat(result)
+        result = progress_callback.result()
+        if result is not None:
             result = {'samples': result}
         else:
             result = latent_image
 
-        return latent_image, result
+        return latent_image, result, progress_callback.preview()
 
 
 class KSamplerAdvanced_progress(a1111_compat.KSamplerAdvanced_inspire):
@@ -72,7 +414,7 @@ class KSamplerAdvanced_progress(a1111_compat.KSamplerAdvanced_inspire):
                      "steps": ("INT", {"default": 20, "min": 1, "max": 10000}),
                      "cfg": ("FLOAT", {"default": 8.0, "min": 0.0, "max": 100.0, "step":0.5, "round": 0.01}),
                      "sampler_name": (comfy.samplers.KSampler.SAMPLERS, ),
-                     "scheduler": (common.SCHEDULERS, ),
+                     "scheduler": (common.KSAMPLER_SCHEDULERS, ),
                      "positive": ("CONDITIONING", ),
                      "negative": ("CONDITIONING", ),
                      "latent_image": ("LATENT", ),
@@ -83,46 +425,43 @@ class KSamplerAdvanced_progress(a1111_compat.KSamplerAdvanced_inspire):
                      "interval": ("INT", {"default": 1, "min": 1, "max": 10000}),
                      "omit_start_latent": ("BOOLEAN", {"default": False, "label_on": "True", "label_off": "False"}),
                      },
-                "optional": {"prev_progress_latent_opt": ("LATENT",), }
+                "optional": {
+                    "prev_progress_latent_opt": ("LATENT",),
+                    "max_frames": ("INT", {"default": 0, "min": 0, "max": 10000}),
+                    "save_prefix": ("STRING", {"default": "", "placeholder": "If set, each captured latent is saved to the output directory as it's produced."}),
+                    "preview_mode": (["none", "latent2rgb", "taesd"],),
+                    },
+                "hidden": {"prompt": "PROMPT", "unique_id": "UNIQUE_ID"},
                 }
 
     FUNCTION = "doit"
 
     CATEGORY = "InspirePack/analysis"
 
-    RETURN_TYPES = ("LATENT", "LATENT")
-    RETURN_NAMES = ("latent", "progress_latent")
+    RETURN_TYPES = ("LATENT", "LATENT", "IMAGE")
+    RETURN_NAMES = ("latent", "progress_latent", "progress_preview")
 
     def doit(self, model, add_noise, noise_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, start_at_step, end_at_step,
-             noise_mode, return_with_leftover_noise, interval, omit_start_latent, prev_progress_latent_opt=None):
-        if omit_start_latent:
-            result = []
-        else:
-            result = [latent_image['samples']]
-
-        result = []
-
-        def progress_callback(step, x0, x, total_steps):
-            if (total_steps-1) != step and step % interval != 0:
-                return
-
-            x = model.model.process_latent_out(x)
-            x = x.to(model_management.intermediate_device())
-            result.append(x)
+             noise_mode, return_with_leftover_noise, interval, omit_start_latent, prev_progress_latent_opt=None, max_frames=0, save_prefix="", preview_mode="none",
+             prompt=None, unique_id=None):
+        progress_callback = ProgressCapture(model, interval, max_frames, save_prefix, preview_mode)
 
         latent_image, noise = a1111_compat.KSamplerAdvanced_inspire.sample(model, add_noise, noise_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, start_at_step, end_at_step,
                                                                            noise_mode, False, callback=progress_callback)
 
-        if len(result) > 0:
-            result = torch.cat(result)
-            result = {'samples': result}
+        result = progress_callback.result()
+        if result is not None:
+            chunks = [result]
         else:
-            result = latent_image
+            chunks = [latent_image['samples']]
 
         if prev_progress_latent_opt is not None:
-            result['samples'] = torch.cat((prev_progress_latent_opt['samples'], result['samples']), dim=0)
+            chunks = ProgressLatent.chunks_of(prev_progress_latent_opt) + chunks
+
+        # NOTE: other consumers may use any dict API, so the lazy 'samples' is kept only along a chain of progress nodes
+        lazy = is_chained_to_progress_only(prompt, unique_id, 1)
 
-        return latent_image, result
+        return latent_image, ProgressLatent(chunks, lazy=lazy), progress_callback.preview()
 
 
 NODE_CLASS_MAPPINGS = {